@@ -2,11 +2,14 @@ from peak import context
 from peak.events import trellis, stm
 from peak.util import addons, decorators, symbols
 from peak.util.extremes import Min, Max
-import heapq, time, sys
+import heapq, time, sys, os, errno, select, types, itertools, threading
+deque = __import__('collections', {}).deque    # not peak.events.collections
 
 __all__ = [
     'Time', 'EPOCH', 'NOT_YET', 'EventLoop', 'WXEventLoop', 'TwistedEventLoop',
-    'task', 'resume', 'Pause', 'Return', 'TaskCell',
+    'AsyncioEventLoop', 'SelectEventLoop', 'VirtualEventLoop',
+    'task', 'resume', 'Pause', 'Return', 'TaskCell', 'throttle',
+    'ThrottledPerformer',
 ]
 
 try:
@@ -128,10 +131,18 @@ class EventLoop(trellis.Component, context.Service):
         stop_requested = False,
     )
 
-    _call_queue = trellis.make(list, writable=True)
+    _call_queue = trellis.make(deque)
     _next_time = trellis.compute(lambda self: Time.next_event_time(True))
 
     _callback_active = initialized = False
+    _posted = False     # a callback has been requested for the inbox
+    conflate = False    # only deliver the last value post()ed to each cell
+
+    batch_size = None   # max. calls to run in a single recalculation
+    batch_time = None   # max. seconds of calls to run in one recalculation
+
+    calls_run = max_depth = 0           # queue statistics
+    total_latency = max_latency = 0.0   # seconds from call() to execution
 
     def run(self):
         """Loop updating the time and invoking requested calls"""
@@ -155,11 +166,14 @@ class EventLoop(trellis.Component, context.Service):
     decorators.decorate(trellis.modifier)
     def call(self, func, *args, **kw):
         """Call `func(*args, **kw)` at the next opportunity"""
-        self._call_queue.append((func, args, kw))
+        queue = self._call_queue
+        queue.append((func, args, kw, time.time()))
+        if len(queue) > self.max_depth:
+            self.max_depth = len(queue)
         if not self.initialized:
             self._setup()
             self.initialized = True
-        trellis.on_undo(self._call_queue.pop)
+        trellis.on_undo(queue.pop)
         self._callback_if_needed()
 
     def poll(self):
@@ -167,32 +181,213 @@ class EventLoop(trellis.Component, context.Service):
         self.flush(1)
 
     def flush(self, count=0):
-        """Execute the specified number of pending calls (0 for all)"""
+        """Execute the specified number of pending calls (0 for all)
+
+        If `batch_size` or `batch_time` is set, the calls are run in batches,
+        each inside a single recalculation, with the time updated between
+        batches so that timers aren't starved by a long queue.
+        """
         assert not trellis.ctrl.active, "Event loop can't be run atomically"
-        queue = self._split_queue(count)
-        for (f, args, kw) in queue:
-            f(*args, **kw)
-        self._callback_if_needed()
+        self._posted = False
+        if self._inbox:
+            self._drain_inbox()
+        queue = self._call_queue
+        count = min(count or len(queue), len(queue))
+        while True:
+            if self.batch_size or self.batch_time:
+                if count and queue[0][0] == self._run_tasks:
+                    # tasks need their own recalculations, not the batch's
+                    count -= 1
+                    self._run_call(queue.popleft())
+                else:
+                    count -= trellis.atomically(self._run_batch, count)
+            else:
+                while count:
+                    count -= 1
+                    self._run_call(queue.popleft())
+            self._callback_if_needed()
+            self._update_time()
+            if not count or not queue:
+                break
+
+    def _update_time(self):
         if Time.auto_update:
-            Time.tick()                                        
+            Time.tick()
         else:
             Time.advance(self._next_time or 0)
 
+    def _run_batch(self, count):
+        queue, batch_time = self._call_queue, self.batch_time
+        if self.batch_size:
+            count = min(count, self.batch_size)
+        if batch_time:
+            deadline = time.time() + batch_time
+        ran = 0
+        while ran < count and queue[0][0] != self._run_tasks:
+            ran += 1
+            item = queue.popleft()
+            self._run_call(item)
+            # If a later call fails, this one is rolled back and run again
+            trellis.on_undo(queue.appendleft, item)
+            if batch_time and time.time() >= deadline:
+                break
+        return ran
+
+    def _run_call(self, item):
+        func, args, kw, queued = item
+        latency = time.time() - queued
+        self.calls_run += 1
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+        func(*args, **kw)
+
+    decorators.decorate(property)
+    def queue_depth(self):
+        """The number of calls waiting to be run"""
+        return len(self._call_queue)
+
+    task_time = None    # max. seconds of ready tasks to run in one recalculation
+    task_stats = trellis.make(dict)     # {priority: [runs, total, max latency]}
+    _ready_tasks = trellis.make(list)   # [(task, time scheduled)]
+
+    def _schedule_task(self, task):
+        # Tasks woken before the next flush are all run by one _run_tasks call
+        ready = self._ready_tasks
+        if not ready:
+            self.call(self._run_tasks)
+        ready.append((task, time.time()))
+        trellis.on_undo(ready.pop)
+
+    def _run_tasks(self):
+        """Run the ready tasks, each in its own recalculation"""
+        ready, stats = self._ready_tasks, self.task_stats
+        task_time = self.task_time
+        tasks = ready[:]
+        del ready[:]
+        tasks.sort(key=lambda item: item[0].priority, reverse=True)
+        if task_time:
+            deadline = time.time() + task_time
+        errors = []
+        for pos, (task, queued) in enumerate(tasks):
+            now = time.time()
+            if task_time and pos and now >= deadline:
+                # Out of time: let queued calls and timers run before the rest
+                if not ready:
+                    self.call(self._run_tasks)
+                ready[:0] = tasks[pos:]
+                break
+            latency = now - queued
+            stat = stats.get(task.priority)
+            if stat is None:
+                stat = stats[task.priority] = [0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += latency
+            if latency > stat[2]:
+                stat[2] = latency
+            # Tasks are separate writers, so a failing task doesn't stop the
+            # others from running
+            try:
+                trellis.atomically(task.do_run)
+            except:
+                errors.append(sys.exc_info())
+        if errors:
+            e = errors[0]
+            try:
+                raise e[0], e[1], e[2]
+            finally:
+                del e, errors
+
+    # [(cell or None, receiver, value)], appended to from any thread
+    _inbox = trellis.make(deque, optional=False)
+    _wakeup = trellis.make(threading.Event, optional=False)  # set by _post()
+
+    def post(self, cell, value):
+        """Set `cell` to `value` at the next opportunity
+
+        Unlike ``call()``, this is safe to use from any thread, as it doesn't
+        touch any Trellis state: everything posted between two flushes of the
+        event loop is delivered in a single recalculation.  If `conflate` is
+        set, only the last value posted to each cell is delivered.
+        """
+        self._post(cell, cell.set_value, value)
+
+    def _post(self, key, receiver, value):
+        self._inbox.append((key, receiver, value))   # deque.append is atomic
+        self._wakeup.set()
+        if not self._posted and self.initialized:
+            self._posted = True
+            self._arrange_callback(self._callback)
+
+    def _drain_inbox(self):
+        inbox = self._inbox
+        items = []
+        while inbox:
+            items.append(inbox.popleft())
+        if self.conflate:
+            last = dict([(item[0], item) for item in items])
+            items = [
+                item for item in items
+                if item[0] is None or last[item[0]] is item
+            ]
+        try:
+            trellis.atomically(self._deliver, items)
+        except:
+            if len(items) == 1:
+                raise
+            # Deliver the items one at a time instead, dropping any that fail,
+            # so that one bad value doesn't stop (or repeat) all the others
+            errors = [sys.exc_info()]
+            for item in items:
+                try:
+                    trellis.atomically(self._deliver, [item])
+                except:
+                    errors.append(sys.exc_info())
+            e = errors[len(errors)>1]
+            try:
+                raise e[0], e[1], e[2]
+            finally:
+                del e, errors
+
+    def _deliver(self, items):
+        for key, receiver, value in items:
+            receiver(value)
+
+    _waiting = trellis.make(dict)   # {id(future): task waiting for it}
+
+    decorators.decorate(property)
+    def _jobs(self):
+        """The number of futures that tasks are waiting on"""
+        return len(self._waiting)
+
+    def _wait_for(self, task, future):
+        # Resume `task` with the result of `future` once it's done
+        if not self.initialized:
+            self._setup()
+            self.initialized = True
+        waiting, key = self._waiting, id(future)
+        waiting[key] = task
+        trellis.on_undo(waiting.pop, key)
+        # The callback can't be taken back, so only add it if the wait commits
+        trellis.on_commit(future.add_done_callback, self._future_done)
+
+    def _future_done(self, future):
+        self._post(None, self._job_done, future)
+
+    def _job_done(self, future):
+        waiting, key = self._waiting, id(future)
+        task = waiting.pop(key, None)
+        if task is None:
+            return  # no task is waiting for it (e.g. the wait was rolled back)
+        trellis.on_undo(waiting.__setitem__, key, task)
+        task._receive(future)
+
     decorators.decorate(trellis.modifier)
     def _callback_if_needed(self):
         if self._call_queue and not self._callback_active:
             self._arrange_callback(self._callback)
             self._callback_active = True
         
-    decorators.decorate(trellis.modifier)
-    def _split_queue(self, count):
-        queue = self._call_queue
-        count = count or len(queue)
-        if queue:
-            head, self._call_queue = queue[:count], queue[count:]
-            return head
-        return ()
-
     decorators.decorate(trellis.modifier)
     def _tearDown(self):
         self.running = False
@@ -200,13 +395,29 @@ class EventLoop(trellis.Component, context.Service):
 
     def _callback(self):
         self._callback_active = False
-        self.flush(1)
+        self._flush_some()
+
+    def _flush_some(self):
+        # With a batch_time, run everything queued, in batches of that long;
+        # otherwise, run one batch_size (or one call) at a time
+        if self.batch_time:
+            self.flush()
+        else:
+            self.flush(self.batch_size or 1)
 
 
     def _loop(self):
         """Subclasses should invoke their external loop here"""
-        while (self._call_queue or self._next_time) and not self.stop_requested:
-            self.flush(1)
+        wakeup = self._wakeup
+        while (
+            self._call_queue or self._inbox or self._next_time or self._jobs
+        ) and not self.stop_requested:
+            wakeup.clear()
+            if not self._call_queue and not self._inbox and Time.auto_update:
+                # Sleep until the next timer, or until something is posted
+                # (e.g. by a future's callback); None means no timers
+                wakeup.wait(self._next_time)
+            self._flush_some()
 
     def _setup(self):
         """Subclasses should import/setup their external loop here
@@ -269,7 +480,7 @@ class TwistedEventLoop(EventLoop):
         self.reactor.run()
 
     def _arrange_callback(self, func):
-        self.reactor.callLater(0, func)
+        self.reactor.callFromThread(func)
 
     def _setup(self):
         from twisted.internet import reactor
@@ -285,6 +496,228 @@ class TwistedEventLoop(EventLoop):
 
 
 
+class AsyncioEventLoop(EventLoop):
+    """asyncio version of the event loop (uses ``trollius`` on Python 2)"""
+
+    context.replaces(EventLoop)
+    loop = _timer = None
+
+    trellis.perform()
+    def _ticker(self):
+        if self.running:
+            if Time.auto_update:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if self._next_time is not None:
+                    self._timer = self.loop.call_at(
+                        self.loop.time() + self._next_time, Time.tick
+                    )
+            if self.stop_requested:
+                self.loop.stop()
+
+    def _loop(self):
+        """Loop updating the time and invoking requested calls"""
+        self.loop.run_forever()
+
+    def _arrange_callback(self, func):
+        self.loop.call_soon_threadsafe(func)
+
+    def _setup(self):
+        if self.loop is not None:
+            return  # use the loop we were given
+        try:
+            import asyncio
+        except ImportError:
+            import trollius as asyncio
+        self.loop = asyncio.get_event_loop()
+
+
+def _fileno(ob):
+    if isinstance(ob, (int, long)):
+        return ob
+    return ob.fileno()
+
+_EAGAIN = errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR
+_IN, _OUT = getattr(select, 'EPOLLIN', 1), getattr(select, 'EPOLLOUT', 4)
+
+class SelectEventLoop(EventLoop):
+    """Event loop that waits for timeouts and file descriptor I/O
+
+    Uses ``select.epoll`` where available, or ``select.select()`` otherwise.
+    Rules can wait for I/O using ``readable()``, ``writable()``, and
+    ``received()``, whose sensors are only registered with the poller while
+    something is listening to them.
+    """
+
+    context.replaces(EventLoop)
+
+    buffer_size = 65536
+    _epoll = _waker = None
+
+    _io = trellis.cellcache(lambda self, key: None, resetting_to=None)
+    trellis.make.attrs(
+        _watching = dict,   # {(fd, kind): True}
+        _registered = dict, # {fd: event mask}
+        _files = dict,      # {fd: socket} for received()
+        _buffers = dict,    # {fd: bytearray} for received()
+        _closed = dict,     # {fd: True} once received() gets EOF
+    )
+
+    def readable(self, ob):
+        """True when `ob` (a file descriptor or object with a ``fileno()``)
+        has data to read; rules that check it are re-run when it does"""
+        return self._io[_fileno(ob), 'readable'].value
+
+    def writable(self, ob):
+        """True when `ob` can be written to without blocking"""
+        return self._io[_fileno(ob), 'writable'].value
+
+    def received(self, sock):
+        """The data most recently read from `sock`, or ``None``
+
+        While a rule is listening, the event loop reads from `sock` as soon as
+        data arrives, into a buffer that's allocated once for each socket.  The
+        data is returned as a ``memoryview`` of that buffer, which is reused
+        for the next read, so copy anything you need to keep.  An empty view
+        means the other end has closed the connection.
+        """
+        fd = _fileno(sock)
+        self._files[fd] = sock
+        return self._io[fd, 'received'].value
+
+    _io.connector()
+    def _watch(self, key):
+        if not self.initialized:
+            self._setup()
+            self.initialized = True
+        fd, kind = key
+        self._watching[key] = True
+        if kind == 'received' and fd not in self._buffers:
+            self._buffers[fd] = bytearray(self.buffer_size)
+        self._update_fd(fd)
+
+    _io.disconnector()
+    def _unwatch(self, key):
+        fd, kind = key
+        del self._watching[key]
+        if kind == 'received':
+            self._files.pop(fd, None)
+            self._buffers.pop(fd, None)
+            self._closed.pop(fd, None)
+        self._update_fd(fd)
+
+    def _update_fd(self, fd):
+        watching = self._watching
+        mask = 0
+        if fd not in self._closed and (
+            (fd, 'readable') in watching or (fd, 'received') in watching
+        ):
+            mask |= _IN
+        if (fd, 'writable') in watching:
+            mask |= _OUT
+        old = self._registered.get(fd, 0)
+        if mask == old:
+            return
+        elif mask:
+            self._registered[fd] = mask
+        else:
+            del self._registered[fd]
+        if self._epoll is not None:
+            try:
+                if not old:
+                    self._epoll.register(fd, mask)
+                elif mask:
+                    self._epoll.modify(fd, mask)
+                else:
+                    self._epoll.unregister(fd)
+            except (IOError, OSError):
+                pass    # fd was already closed
+
+    def _setup(self):
+        import fcntl
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        self._waker, self._wake_fd = os.pipe()
+        for fd in self._waker, self._wake_fd:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK
+            )
+        self._registered[self._waker] = _IN
+        if self._epoll is not None:
+            self._epoll.register(self._waker, _IN)
+
+    def _arrange_callback(self, func):
+        # Wake up the poller, even if it's waiting in another thread
+        try:
+            os.write(self._wake_fd, 'x')
+        except OSError, e:
+            if e.args[0] not in _EAGAIN:
+                raise
+
+    def _loop(self):
+        """Loop updating the time, invoking requested calls, and doing I/O"""
+        while (
+            self._call_queue or self._inbox or self._next_time is not None
+            or self._jobs or len(self._registered)>1
+        ) and not self.stop_requested:
+            timeout = self._next_time
+            if self._call_queue or not Time.auto_update and timeout is not None:
+                timeout = 0
+            events = self._poll(timeout)
+            if events:
+                trellis.atomically(self._dispatch, events)
+            self._flush_some()
+
+    def _poll(self, timeout):
+        try:
+            if self._epoll is not None:
+                return self._epoll.poll([timeout, -1][timeout is None])
+            registered = self._registered
+            r, w, x = select.select(
+                [fd for fd in registered if registered[fd] & _IN],
+                [fd for fd in registered if registered[fd] & _OUT],
+                [], timeout
+            )
+        except (IOError, OSError, select.error), e:
+            if e.args[0] not in _EAGAIN:
+                raise
+            return ()
+        return [(fd, _IN) for fd in r] + [(fd, _OUT) for fd in w]
+
+    def _dispatch(self, events):
+        watching, io = self._watching, self._io
+        for fd, mask in events:
+            if fd == self._waker:
+                try:
+                    while os.read(fd, 4096): pass
+                except OSError, e:
+                    if e.args[0] not in _EAGAIN:
+                        raise
+                self._callback_active = False
+                continue
+            readable = mask & ~_OUT     # errors and hangups, too
+            if readable and (fd, 'received') in watching:
+                self._receive(fd)
+            if readable and (fd, 'readable') in watching:
+                io[fd, 'readable'].receive(True)
+            if mask & _OUT and (fd, 'writable') in watching:
+                io[fd, 'writable'].receive(True)
+
+    def _receive(self, fd):
+        buf = self._buffers[fd]
+        try:
+            count = self._files[fd].recv_into(buf)
+        except (IOError, OSError), e:
+            if e.args[0] in _EAGAIN:
+                return
+            count = 0   # treat a broken connection as closed
+        if not count:
+            self._closed[fd] = True     # stop polling at EOF
+            self._update_fd(fd)
+        self._io[fd, 'received'].receive(memoryview(buf)[:count])
+
+
 class WXEventLoop(EventLoop):
     """wxPython version of the event loop
 
@@ -326,41 +759,427 @@ class WXEventLoop(EventLoop):
         import wx
         self.wx = wx
 
+class VirtualEventLoop(EventLoop):
+    """Event loop that runs in simulated time, for tests and load testing
+
+    Instead of waiting for timeouts, ``run()`` jumps the ``Time`` service
+    straight to the next scheduled event whenever there are no calls to run,
+    so that timers, inputs, and tasks run as fast as the CPU allows.
+    """
+
+    context.replaces(EventLoop)
+    run_stats = None
+    _until = None
+
+    _scheduled = trellis.make(list)     # heap of (when, seq, func, args, kw)
+    _seq = trellis.make(itertools.count)
+
+    def __init__(self, **kw):
+        super(VirtualEventLoop, self).__init__(**kw)
+        # Stop the clock right away, so that it doesn't creep forward in real
+        # time between the loop's creation and its first jump
+        Time.auto_update = False
+
+    def run(self, duration=None):
+        """Run until there's nothing left to do, or `duration` has passed
+
+        Afterwards, ``run_stats`` is a dictionary with the ``wall_time`` and
+        ``virtual_time`` taken, the number of ``calls`` run and time ``jumps``
+        made, and the resulting ``events_per_second`` and ``seconds_per_event``
+        (each call or jump counting as an event).
+        """
+        assert not self.running, "EventLoop is already running"
+        assert not trellis.ctrl.active, "Event loop can't be run atomically"
+        self._until = duration
+        self.stop_requested = False
+        self.running = True
+        try:
+            self._loop()    # no tick(), so time never jumps back to the clock
+            self.stop()
+        finally:
+            self._until = None
+            self._tearDown()
+
+    decorators.decorate(trellis.modifier)
+    def call_later(self, delay, func, *args, **kw):
+        """Call `func(*args, **kw)` after `delay` seconds of simulated time"""
+        item = Time.get()._now + delay, self._seq.next(), func, args, kw
+        heapq.heappush(self._scheduled, item)
+        trellis.on_undo(self._unschedule, item)
+
+    def _unschedule(self, item):
+        scheduled = self._scheduled
+        scheduled.remove(item)
+        heapq.heapify(scheduled)
+
+    def _update_time(self):
+        pass    # time only moves when _loop() has nothing else to do
+
+    def _jump(self, clock, when):
+        # Advance to `when` and run the calls due then, in one recalculation
+        clock.advance(when - clock._now)
+        scheduled = self._scheduled
+        ran = 0
+        while scheduled and scheduled[0][0] <= when:
+            item = heapq.heappop(scheduled)
+            trellis.on_undo(heapq.heappush, scheduled, item)
+            item[2](*item[3], **item[4])
+            ran += 1
+        return ran
+
+    def _loop(self):
+        """Run calls, jumping straight to the next event when idle"""
+        clock = Time.get()
+        clock.auto_update = False
+        wakeup = self._wakeup
+        queue, inbox, scheduled = self._call_queue, self._inbox, self._scheduled
+        started, begin, calls = time.time(), clock._now, self.calls_run
+        until = self._until
+        if until is not None:
+            until += begin
+        jumps = 0
+        while not self.stop_requested:
+            wakeup.clear()
+            if queue or inbox:
+                self.flush()
+                continue
+            now = clock._now
+            when = clock._next_event
+            if when is Max:
+                when = None
+            if scheduled and (when is None or scheduled[0][0] < when):
+                when = scheduled[0][0]
+            if when is None:
+                if self._jobs:
+                    wakeup.wait()   # for futures being run by other threads
+                    continue
+                break
+            if until is not None and when > until:
+                clock.advance(until - now)
+                break
+            jumps += 1
+            calls -= trellis.atomically(self._jump, clock, max(when, now))
+
+        wall = time.time() - started
+        calls = self.calls_run - calls
+        events = calls + jumps
+        self.run_stats = dict(
+            wall_time=wall, virtual_time=clock._now - begin,
+            calls=calls, jumps=jumps,
+            events_per_second=wall and events / wall or None,
+            seconds_per_event=events and wall / events or None,
+        )
+
+
+class _TimerHeap(list):
+    """Heap of pending event times, compacted when half of it is cancelled"""
+
+    def __init__(self):
+        list.__init__(self, [Max])
+        self.members = {}   # {when: False if cancelled}
+        self.cancelled = 0
+
+    def add(self, when):
+        live = self.members.get(when)
+        if live is None:
+            heapq.heappush(self, when)
+        elif not live:
+            self.cancelled -= 1
+        self.members[when] = True
+
+    def restore(self, times):
+        for when in times:
+            self.add(when)
+
+    def discard(self, when):
+        if self.members.get(when):
+            self.members[when] = False
+            self.cancelled += 1
+            if self.cancelled*2 > len(self.members):
+                self.compact()
+
+    def compact(self):
+        """Drop cancelled entries from the heap"""
+        members = self.members
+        for when, live in members.items():
+            if not live:
+                del members[when]
+        self[:] = members.keys()
+        self.append(Max)
+        heapq.heapify(self)
+        self.cancelled = 0
+
+    def pop_due(self, now):
+        """Remove and return the live times that are ``<= now``"""
+        due = []
+        while now >= self[0]:
+            when = heapq.heappop(self)
+            if self.members.pop(when):
+                due.append(when)
+            else:
+                self.cancelled -= 1
+        return due
+
+    def first(self):
+        """The earliest pending time, or ``Max``"""
+        while self[0] is not Max and not self.members[self[0]]:
+            del self.members[heapq.heappop(self)]
+            self.cancelled -= 1
+        return self[0]
+
+
+class _TimingWheel(object):
+    """Hierarchical timing wheel of pending event times
+
+    Times are bucketed into ticks of `resolution` seconds.  Each of the
+    `levels` wheels has ``2**bits`` slots, and each slot spans one full turn of
+    the wheel below it; times beyond the top wheel wait in an overflow bucket.
+    Adding and cancelling are O(1), and a wheel's slot is redistributed to the
+    lower wheels only when the current tick reaches it.  Empty stretches of
+    the wheels are skipped, so advancing the time costs nothing unless there
+    are events to expire.
+    """
+
+    def __init__(self, resolution, now=0, bits=8, levels=4):
+        self.resolution = resolution
+        self.bits = bits
+        self.mask = (1<<bits) - 1
+        self.levels = levels
+        self.wheels = [[{} for slot in range(1<<bits)] for l in range(levels)]
+        self.overflow = {}  # {when: tick} beyond the top wheel
+        self.ready = {}     # {when: tick} behind the current tick
+        self.counts = [0] * (levels+2)  # entries per wheel, overflow, ready
+        self.where = {}     # {when: (level, bucket)}
+        self.current = int(now // resolution)  # tick of the last slot entered
+        self._first = Max   # cached result of first(), or None
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, when):
+        if when is Max or when in self.where:
+            return
+        self._insert(when, int(when // self.resolution))
+        if self._first is not None and when < self._first:
+            self._first = when
+
+    def restore(self, times):
+        for when in times:
+            self.add(when)
+
+    def discard(self, when):
+        loc = self.where.pop(when, None)
+        if loc is not None:
+            level, bucket = loc
+            del bucket[when]
+            self.counts[level] -= 1
+            if when == self._first:
+                self._first = None
+
+    def _bucket(self, level, tick):
+        if level < self.levels:
+            return self.wheels[level][(tick >> self.bits*level) & self.mask]
+        return [self.overflow, self.ready][level - self.levels]
+
+    def _insert(self, when, tick):
+        cur, bits = self.current, self.bits
+        diff = (tick ^ cur) >> bits
+        if not diff and tick >= cur:
+            level, bucket = 0, self.wheels[0][tick & self.mask]
+        elif tick < cur:
+            level, bucket = self.levels + 1, self.ready
+        else:
+            level = 1
+            diff >>= bits
+            while diff and level < self.levels:
+                diff >>= bits
+                level += 1
+            bucket = self._bucket(level, tick)
+        bucket[when] = tick
+        self.where[when] = level, bucket
+        self.counts[level] += 1
+
+    def _take(self, level, bucket, due, now):
+        where, taken = self.where, 0
+        for when in bucket.keys():
+            if when <= now:
+                del bucket[when], where[when]
+                due.append(when)
+                taken += 1
+        self.counts[level] -= taken
+
+    def _take_all(self, level, bucket, due):
+        where = self.where
+        for when in bucket:
+            del where[when]
+        due.extend(bucket)
+        self.counts[level] -= len(bucket)
+        bucket.clear()
+
+    def pop_due(self, now):
+        """Remove and return the times that are ``<= now``"""
+        due = []
+        ready = self.levels + 1
+        if self.counts[ready]:
+            self._take(ready, self.ready, due, now)
+        target = int(now // self.resolution)
+        cur = self.current
+        wheel, mask = self.wheels[0], self.mask
+        while True:
+            # Sweep the bottom wheel up to the target or the end of its turn
+            last = min(target, cur | mask)
+            if self.counts[0]:
+                for slot in range(cur & mask, last & mask):
+                    if wheel[slot]:
+                        self._take_all(0, wheel[slot], due)
+                bucket = wheel[last & mask]
+                if bucket:
+                    if last < target:
+                        self._take_all(0, bucket, due)
+                    else:
+                        self._take(0, bucket, due, now)
+            cur = last
+            if cur >= target:
+                break
+            cur = self._advance(cur, target)
+        self.current = max(cur, self.current)
+        if due:
+            self._first = None
+        return due
+
+    def _advance(self, cur, target):
+        """Enter the next tick that could hold events, or `target`"""
+        counts, levels = self.counts, self.levels
+        level = 0
+        while level <= levels and not counts[level]:
+            level += 1
+        if level > levels:
+            return target   # nothing left to expire or redistribute
+        elif not level:
+            self._cascade(cur+1)    # the bottom wheel's turn is over
+            return cur+1
+        span = 1 << self.bits*level
+        nxt = (cur | (span-1)) + 1
+        if level == levels:
+            nxt = max(nxt, min(self.overflow.itervalues()) & ~(span-1))
+        if nxt > target:
+            return target
+        self._cascade(nxt)
+        return nxt
+
+    def _cascade(self, tick):
+        """Redistribute the slots that begin at `tick` to the lower wheels"""
+        self.current = tick
+        bits, levels, counts = self.bits, self.levels, self.counts
+        top = 0
+        while top < levels and not tick & ((1 << bits*(top+1)) - 1):
+            top += 1
+        for level in range(top, 0, -1):
+            bucket = self._bucket(level, tick)
+            if bucket:
+                items = bucket.items()
+                bucket.clear()
+                counts[level] -= len(items)
+                for when, t in items:
+                    self._insert(when, t)
+
+    def first(self):
+        """The earliest pending time, or ``Max``"""
+        if self._first is None:
+            self._first = self._find_first()
+        return self._first
+
+    def _find_first(self):
+        counts, levels, cur = self.counts, self.levels, self.current
+        best = Max
+        if counts[levels+1]:
+            best = min(self.ready)
+        for level in range(levels):
+            if counts[level]:
+                wheel = self.wheels[level]
+                for slot in range((cur >> self.bits*level) & self.mask, 1<<self.bits):
+                    if wheel[slot]:
+                        return min(best, min(wheel[slot]))
+        if counts[levels]:
+            return min(best, min(self.overflow))
+        return best
+
+
+_last_time = [0]
+def _clamped_time():
+    # No monotonic clock available, so just don't let time go backwards
+    now = time.time()
+    if now < _last_time[0]:
+        return _last_time[0]
+    _last_time[0] = now
+    return now
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    if os.times()[4]:
+        # The elapsed real time (e.g. since boot) isn't affected by setting
+        # the system clock; offset it to start out near time.time()
+        _elapsed_offset = time.time() - os.times()[4]
+        def _monotonic():
+            return os.times()[4] + _elapsed_offset
+    else:
+        _monotonic = _clamped_time  # e.g. Windows, where os.times() is CPU-only
+
+
 class Time(trellis.Component, context.Service):
     """Manage current time and intervals"""
 
     _now = EPOCH._when
+    resolution = None   # seconds per tick, to use a timing wheel for events
+    monotonic = False   # use a clock that can't be set backwards
+    quantum = None      # round the clock down to a multiple of this many secs
     auto_update = trellis.attr(True)
-    _schedule = trellis.make(lambda self: [Max], writable=True)
+    _schedule = trellis.make(lambda self: self._new_schedule(), writable=True)
     _events = trellis.cellcache(lambda self, key: False)
 
+    def _new_schedule(self):
+        if self.resolution:
+            return _TimingWheel(self.resolution, self._now)
+        return _TimerHeap()
+
     _events.connector()
     def _add_event(self, when):
-        # this heappush doesn't need an undo, since _next_event() ignores extras
-        heapq.heappush(self._schedule, when)
+        # this add doesn't need an undo, since _next_event() ignores extras
+        self._schedule.add(when)
         trellis.changed(trellis.Cells(self)['_schedule'])
 
     _events.disconnector()
     def _del_event(self, when):
-        pass
+        self._schedule.discard(when)
+        trellis.changed(trellis.Cells(self)['_schedule'])
 
     trellis.maintain()
     def _next_event(self):
         schedule = self._schedule
-        while self._tick >= schedule[0]:
-            key = heapq.heappop(schedule)
-            trellis.on_undo(heapq.heappush, schedule, key)
-            if key in self._events:
-                self._events[key].receive(True)
-        return schedule[0]
-    
+        due = schedule.pop_due(self._tick)
+        if due:
+            trellis.on_undo(schedule.restore, due)
+            events = self._events
+            for key in due:
+                if key in events:
+                    events[key].receive(True)
+        return schedule.first()
+
     def reached(self, timer):
         when = timer._when
         return self._now >= when or (
             trellis.ctrl.current_listener is not None
-            and self._events[when].value
+            and self._events[self._event_key(when)].value
         )
 
+    def _event_key(self, when):
+        # With a resolution, round up so that nearby timers share an event
+        resolution = self.resolution
+        if resolution and when is not Max:
+            return -(-when // resolution) * resolution
+        return when
+
     def __getitem__(self, interval):
         """Return a timer that's the given offset from the current time"""
         return _Timer(self._now + interval)
@@ -372,7 +1191,7 @@ class Time(trellis.Component, context.Service):
         self._set(self._now + interval)
 
     def tick(self):
-        """Update current time to match ``time.time()``"""
+        """Update current time to match ``self.time()``"""
         self._set(self.time())
 
     def _set(self, when):
@@ -392,7 +1211,7 @@ class Time(trellis.Component, context.Service):
         """The time of the next event to occur, or ``None`` if none scheduled
 
         If `relative` is True, returns the number of seconds until the event;
-        otherwise, returns the absolute ``time.time()`` of the event.
+        otherwise, returns the absolute ``time()`` of the event.
         """
         now = self._tick   # ensure recalc whenever time moves forward
         when = self._next_event
@@ -402,7 +1221,42 @@ class Time(trellis.Component, context.Service):
             return when - now
         return when
 
-    def time(self): return time.time()
+    def time(self):
+        """The clock time used by ``tick()`` and ``auto_update``"""
+        if self.monotonic:
+            now = _monotonic()
+        else:
+            now = time.time()
+        quantum = self.quantum
+        if quantum:
+            now -= now % quantum
+        return now
+
+
+class ThrottledPerformer(stm.AbstractListener, trellis.AbstractCell):
+    """Performer that runs at most once per `interval` seconds
+
+    Changes made before the interval has passed are coalesced, so that the
+    rule runs only once when the interval expires, using the latest state.
+    """
+
+    __slots__ = 'rule', 'interval', '_due', 'next_subject', '__weakref__'
+
+    layer = Max
+
+    def __init__(self, rule, interval):
+        self.rule = rule
+        self.interval = interval
+        self._due = EPOCH
+        super(ThrottledPerformer, self).__init__()
+        trellis.atomically(trellis.schedule, self)
+
+    def run(self):
+        # While waiting, depend only on the timer; the rule's own reads become
+        # our dependencies again once it runs
+        if self._due:
+            trellis.change_attr(self, '_due', Time[self.interval])
+            self.rule()
 
 
 
@@ -413,12 +1267,13 @@ class TaskCell(trellis.AbstractCell, stm.AbstractListener):
     
     __slots__ = (
         '_result', '_error', '_step', 'next_subject', 'layer', '_loop',
-        '_scheduled', '__weakref__',
+        '_scheduled', 'priority', '__weakref__',
     )
 
-    def __init__(self, func):
+    def __init__(self, func, priority=0):
         self._step = self._stepper(func)
         self.layer = 0
+        self.priority = priority
         self.next_subject = None
         self._loop = EventLoop.get()
         self._scheduled = False
@@ -427,9 +1282,19 @@ class TaskCell(trellis.AbstractCell, stm.AbstractListener):
     def dirty(self):
         if not self._scheduled:
             trellis.change_attr(self, '_scheduled', True)
-            trellis.on_commit(self._loop.call, trellis.atomically, self.do_run)
+            trellis.on_commit(self._loop._schedule_task, self)
         return False
 
+    def _receive(self, future):
+        # Called atomically by the event loop when a yielded future is done
+        try:
+            self._result.append(future.result())
+            trellis.on_undo(self._result.pop)
+        except:
+            self._error.append(sys.exc_info())
+            trellis.on_undo(self._error.pop)
+        self.dirty()
+
     decorators.decorate(classmethod)
     def from_attr(cls, rule, value, discrete):
         return cls(rule)
@@ -451,21 +1316,24 @@ class TaskCell(trellis.AbstractCell, stm.AbstractListener):
 
     def _stepper(self, func):
         VALUE = self._result = []
-        ERROR = self._error  = []               
-        STACK = [func()]
-        CALL = STACK.append
+        ERROR = self._error  = []
+        STACK = []  # (next, send, throw) of each iterator being run
+        PUSH = STACK.append
         RETURN = STACK.pop
         ctrl = trellis.ctrl
+        def CALL(it):
+            PUSH((it.next, getattr(it,'send',None), getattr(it,'throw',None)))
+        CALL(func())
         def _step():
             while STACK:
+                next, send, throw = STACK[-1]
                 try:
-                    it = STACK[-1]
-                    if VALUE and hasattr(it, 'send'):
-                        rv = it.send(VALUE[0])
-                    elif ERROR and hasattr(it, 'throw'):
-                        rv = it.throw(*ERROR.pop())
+                    if VALUE and send is not None:
+                        rv = send(VALUE[0])
+                    elif ERROR and throw is not None:
+                        rv = throw(*ERROR.pop())
                     else:
-                        rv = it.next()
+                        rv = next()
                 except:
                     del VALUE[:]
                     ERROR.append(sys.exc_info())
@@ -476,8 +1344,15 @@ class TaskCell(trellis.AbstractCell, stm.AbstractListener):
                     del VALUE[:]
                     if rv is Pause:
                         break
+                    elif type(rv) is GeneratorType:
+                        PUSH((rv.next, rv.send, rv.throw)); continue
                     elif hasattr(rv, 'next'):
                         CALL(rv); continue
+                    elif hasattr(rv, 'add_done_callback'):
+                        # Wait for the future, and only for the future
+                        ctrl.reads.clear()
+                        self._loop._wait_for(self, rv)
+                        return
                     elif isinstance(rv, Return):
                         rv = rv.value
                     VALUE.append(rv)
@@ -518,6 +1393,7 @@ class TaskCell(trellis.AbstractCell, stm.AbstractListener):
             ctrl.current_listener = None
 
 Pause = symbols.Symbol('Pause', __name__)
+GeneratorType = types.GeneratorType
 
 decorators.struct()
 def Return(value):
@@ -545,10 +1421,22 @@ def resume():
         finally:
             del e
 
-def task(rule=None, optional=False):
-    """Define a task cell attribute"""
+def throttle(interval, rule=None, optional=False):
+    """Define a performer that runs at most once per `interval` seconds"""
+    return trellis._build_descriptor(
+        rule=rule, optional=optional,
+        factory=lambda rule, value, discrete: ThrottledPerformer(rule, interval)
+    )
+
+def task(rule=None, optional=False, priority=0):
+    """Define a task cell attribute
+
+    Ready tasks with a higher `priority` are resumed before lower ones."""
+    factory = TaskCell.from_attr
+    if priority:
+        factory = lambda rule, value, discrete: TaskCell(rule, priority)
     return trellis._build_descriptor(
-        rule=rule, factory=TaskCell.from_attr, optional=optional
+        rule=rule, factory=factory, optional=optional
     )
 
 
@@ -1,10 +1,12 @@
-import trellis, bisect
+import trellis, bisect, itertools
+from operator import itemgetter
 from peak.util import decorators
 from trellis import set
 from new import instancemethod
 
 __all__ = [
-    'SortedSet', 'SubSet', 'Observing', 'Hub'
+    'SortedSet', 'SortedWindow', 'SubSet', 'FilteredSet', 'Observing', 'Hub',
+    'BoundedPipe', 'PipeReader',
 ]
 
 
@@ -20,15 +22,51 @@ class SubSet(trellis.Set):
 
     trellis.compute()
     def removed(self):
-        base = self.base
-        if self.base.removed:
-            # XXX need to filter this by self._data somehow
-            return set(self._removed) | set(self.base.removed)
+        removed = self.base.removed
+        if removed:
+            # Only the items we had before this recalculation can be removed,
+            # and the _data rule depends on us, so read its old value as-is
+            data = self.__cells__['_data']._value
+            return set(self._removed) | set(
+                [item for item in removed if item in data]
+            )
         else:
             return self._removed
 
 
+class FilteredSet(trellis.Set):
+    """Read-only set of the items in `base` for which `predicate` is true
+
+    Only the items added to or removed from `base` are tested in each
+    recalculation, so `predicate` should be a plain function whose result for
+    a given item doesn't change while the item is in the base set.  For the
+    same reason, `base` can only be set when the filtered set is created.
+    """
+
+    base = trellis.make(trellis.Set)
+    predicate = trellis.make(lambda self: bool)
+
+    def _read_only(self):
+        raise TypeError("FilteredSet is read-only; change its base instead")
+
+    # All of Set's modifiers go through these, so they'll raise instead of
+    # queueing changes that the added and removed rules would ignore
+    to_add = to_remove = property(_read_only)
+
+    def __init__(self, **kw):
+        trellis.Set.__init__(self, **kw)
+        # we can update self._data in place, since no-one has seen it yet
+        self._data.update(
+            dict.fromkeys(itertools.ifilter(self.predicate, self.base), True)
+        )
 
+    trellis.compute()
+    def added(self):
+        return set(itertools.ifilter(self.predicate, self.base.added))
+
+    trellis.compute()
+    def removed(self):
+        return set(itertools.ifilter(self.predicate, self.base.removed))
 
 
 
@@ -39,6 +77,19 @@ class SubSet(trellis.Set):
 
 
 
+
+
+
+def _pattern(rule):
+    """(positions, values) of a Hub rule's non-None items
+
+    Single values aren't wrapped in a tuple, to match ``itemgetter()``."""
+    positions = tuple([i for i, v in enumerate(rule) if v is not None])
+    values = tuple([rule[i] for i in positions])
+    if len(values) == 1:
+        values = values[0]
+    return positions, values
+
 class Hub(trellis.Component):
     """Pub/sub messaging"""
 
@@ -48,37 +99,42 @@ class Hub(trellis.Component):
 
     def put(self, *row):
         """Send a message to any active subscribers"""
+        hash(row)   # fail early if unhashable
         self._inputs.append(row)
 
     _queries = trellis.cellcache(lambda self,key:(), resetting_to=())
     _inputs = trellis.make(trellis.Pipe)
-    _index = trellis.make(dict)     # {(pos,value):{rule:1}}}
+    _index = trellis.make(dict) # {length: {positions: {values: {rule:1}}}}
 
     _queries.connector()
     def _add_rule(self, rule):
-        key = None
-        for pv in enumerate(rule):
-            if pv[1] is not None:
-                key = pv
-        if key is not None:
-            ind = self._index.setdefault(key, {})
-            ind[rule] = 1
-            trellis.on_undo(ind.pop, rule, 1)
+        positions, values = _pattern(rule)
+        index = self._index
+        for key, default in (len(rule), {}), (positions, {}), (values, {}):
+            if key not in index:
+                index[key] = default
+                trellis.on_undo(index.pop, key, None)
+            index = index[key]
+        index[rule] = 1
+        trellis.on_undo(index.pop, rule, 1)
 
     _queries.disconnector()
     def _del_rule(self, rule):
-        index = self._index
-        for pv in enumerate(rule):
-            if pv in index:
-                index[pv].pop(rule, 1)
-                trellis.on_undo(index[pv].__setitem__, rule, 1)
-                
-
-
-
-
-
-
+        positions, values = _pattern(rule)
+        shapes = self._index[len(rule)]
+        patterns = shapes[positions]
+        rules = patterns[values]
+        del rules[rule]
+        trellis.on_undo(rules.__setitem__, rule, 1)
+        # Drop emptied entries, so _notify doesn't look them up again
+        for d, key, value in (
+            (patterns, values, rules), (shapes, positions, patterns),
+            (self._index, len(rule), shapes)
+        ):
+            if value:
+                break
+            del d[key]
+            trellis.on_undo(d.__setitem__, key, value)
 
     trellis.maintain()
     def _notify(self):
@@ -89,19 +145,26 @@ class Hub(trellis.Component):
             return      # nothing to see, move along...
 
         index = self._index
-        matches = {}
-
+        by_length = {}
         for row in inputs:
-            for pv in enumerate(row):
-                if pv not in index:
+            if len(row) in index:
+                by_length.setdefault(len(row), []).append(row)
+
+        # Look each row up once per distinct pattern "shape" (i.e., set of
+        # non-None positions), instead of testing it against every pattern
+        matches = {}
+        for length, rows in by_length.iteritems():
+            for positions, patterns in index[length].iteritems():
+                if not positions:
+                    for rule in patterns[()]:
+                        matches.setdefault(rule, []).extend(rows)
                     continue
-                for rule in index[pv]:
-                    if len(rule)==len(row):
-                        for v1,v2 in zip(rule, row):
-                            if v1!=v2 and v1 is not None:
-                                break
-                        else:
-                            matches.setdefault(rule,[]).append(row)
+                getter = itemgetter(*positions)
+                for row in rows:
+                    values = getter(row)
+                    if values in patterns:
+                        for rule in patterns[values]:
+                            matches.setdefault(rule, []).append(row)
         if matches:
             queries = self._queries
             for rule in matches:
@@ -162,6 +225,160 @@ class Observing(trellis.Component):
 
 
 
+class _SortedBlocks(object):
+    """Sorted list stored in blocks, with O(log n) updates and indexing
+
+    ``maxes`` holds the last item of each block, for finding the block an item
+    belongs in, and ``tree`` is a Fenwick tree of the block sizes (rebuilt
+    after blocks are split or merged) for converting to and from positions.
+    """
+
+    load = 1000     # blocks are split at twice this size, merged at a quarter
+
+    def __init__(self, items=()):
+        items = list(items)     # must already be sorted
+        load = self.load
+        self.blocks = [items[i:i+load] for i in xrange(0, len(items), load)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.size = len(items)
+        self.tree = None
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return itertools.chain(*self.blocks)
+
+    def __reversed__(self):
+        for block in reversed(self.blocks):
+            for item in reversed(block):
+                yield item
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, stride = index.indices(self.size)
+            if stride != 1:
+                return list(self)[index]
+            items, blocks = [], self.blocks
+            if start < stop:
+                bi, i = self._find(start)
+                while len(items) < stop - start:
+                    items.extend(blocks[bi][i:i + stop - start - len(items)])
+                    bi, i = bi + 1, 0
+            return items
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        bi, i = self._find(index)
+        return self.blocks[bi][i]
+
+    def add(self, item):
+        """Insert `item`, returning its position"""
+        blocks, maxes = self.blocks, self.maxes
+        if not blocks:
+            blocks.append([item])
+            maxes.append(item)
+            self.size, self.tree = 1, None
+            return 0
+        bi = bisect.bisect_left(maxes, item)
+        if bi == len(maxes):
+            bi -= 1
+            block = blocks[bi]
+            i = len(block)
+            maxes[bi] = item
+        else:
+            block = blocks[bi]
+            i = bisect.bisect_left(block, item)
+        pos = self._offset(bi) + i
+        block.insert(i, item)
+        self.size += 1
+        if len(block) > 2 * self.load:
+            half = len(block) >> 1
+            blocks.insert(bi+1, block[half:])
+            maxes.insert(bi+1, block[-1])
+            del block[half:]
+            maxes[bi] = block[-1]
+            self.tree = None
+        elif self.tree is not None:
+            self._update(bi, 1)
+        return pos
+
+    def remove(self, item):
+        """Remove `item`, returning the position it had"""
+        blocks, maxes = self.blocks, self.maxes
+        bi = bisect.bisect_left(maxes, item)
+        if bi == len(maxes):
+            raise ValueError(item)
+        block = blocks[bi]
+        i = bisect.bisect_left(block, item)
+        if block[i] != item:
+            raise ValueError(item)
+        pos = self._offset(bi) + i
+        del block[i]
+        self.size -= 1
+        if not block:
+            del blocks[bi], maxes[bi]
+            self.tree = None
+            return pos
+        maxes[bi] = block[-1]
+        if len(block) < self.load >> 2 and len(blocks) > 1:
+            bi = bi or 1    # merge block `bi` into the one before it
+            blocks[bi-1].extend(blocks[bi])
+            maxes[bi-1] = maxes[bi]
+            del blocks[bi], maxes[bi]
+            self.tree = None
+        elif self.tree is not None:
+            self._update(bi, -1)
+        return pos
+
+    def _build(self):
+        tree = map(len, self.blocks)
+        size = len(tree)
+        for i in xrange(size):
+            j = i | (i+1)
+            if j < size:
+                tree[j] += tree[i]
+        self.tree = tree
+        return tree
+
+    def _update(self, bi, delta):
+        tree = self.tree
+        size = len(tree)
+        while bi < size:
+            tree[bi] += delta
+            bi |= bi + 1
+
+    def _offset(self, bi):
+        # number of items in the blocks before block `bi`
+        tree = self.tree
+        if tree is None:
+            tree = self._build()
+        total = 0
+        while bi:
+            total += tree[bi-1]
+            bi &= bi - 1
+        return total
+
+    def _find(self, index):
+        # (block, offset in block) for position `index`
+        tree = self.tree
+        if tree is None:
+            tree = self._build()
+        size = len(tree)
+        bi = 0
+        step = 1
+        while step <= size:     # int.bit_length() needs Python 2.7
+            step <<= 1
+        while step:
+            nxt = bi + step
+            if nxt <= size and tree[nxt-1] <= index:
+                index -= tree[nxt-1]
+                bi = nxt
+            step >>= 1
+        return bi, index
+
+
 class SortedSet(trellis.Component):
     """Represent a set as a list sorted by a key"""
 
@@ -176,10 +393,28 @@ class SortedSet(trellis.Component):
     changes = trellis.attr(resetting_to=[])
 
     def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, stride = key.indices(len(self.items))
+            if stride != 1:
+                return list(self)[key]
+            if self.reverse:
+                size = len(self.items)
+                items = self.items[size-stop:size-start]
+                items.reverse()
+            else:
+                items = self.items[start:stop]
+            return [ob for k, ob in items]
         if self.reverse:
             key = -(key+1)
         return self.items[int(key)][1]
 
+    def __iter__(self):
+        items = self.items
+        if self.reverse:
+            items = reversed(items)
+        for key, ob in items:
+            yield ob
+
     def __len__(self):
         return len(self.items)
 
@@ -191,7 +426,7 @@ class SortedSet(trellis.Component):
             if data is None or key != self.old_key:
                 data = [(key(ob),ob) for ob in self.data]
                 data.sort()
-                self.items = data
+                self.items = data = _SortedBlocks(data)
             size = len(self.data)
             self.changes = [(0, size, size)]
             self.old_key = key
@@ -210,37 +445,218 @@ class SortedSet(trellis.Component):
         ]
         changes.sort()
         changes.reverse()
-        lo = 0
-        hi = old_size = len(items)
+        old_size = len(items)
         regions = []
         for k, op, ob in changes:
-            ind = (k, ob)
-            if lo<hi and items[hi-1][0]>=ind:
-                pos = hi-1    # shortcut
-            if lo<hi and ind>=items[hi-1]:
-                # shortcut
-                if ind==items[hi-1]:
-                    pos = hi-1
-                else:
-                    pos = hi
-            else:
-                pos = bisect.bisect_left(items, ind, lo, hi)
-
             if op=='-':
-                del items[pos]
+                pos = items.remove((k, ob))
                 if regions and regions[-1][0]==pos+1:
                     regions[-1] = (pos, regions[-1][1], regions[-1][2])
                 else:
                     regions.append((pos, pos+1, 0))
             else:
-                items.insert(pos, ind)
+                pos = items.add((k, ob))
                 if regions and regions[-1][0]==pos:
                     regions[-1] = (pos, regions[-1][1], regions[-1][2]+1)
                 else:
                     regions.append((pos, pos, 1))
-            hi=pos
 
         if reverse:
             return [(old_size-e, old_size-s, sz) for (s,e,sz) in regions[::-1]]
         return regions
 
+
+
+
+class SortedWindow(trellis.Component):
+    """The `limit` items of a SortedSet starting at position `offset`
+
+    Only the visible items are fetched, and ``changes`` lists ``(start, end,
+    size)`` regions relative to the window, so changes elsewhere in the
+    `source` don't cause any downstream recalculation unless they shift the
+    window's contents.
+    """
+
+    trellis.attrs(
+        source = None,
+        offset = 0,
+        limit = 50,
+        old_view = None,
+    )
+    changes = trellis.attr(resetting_to=[])
+
+    def __getitem__(self, key):
+        return self.rows[key]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __repr__(self):
+        return repr(self.rows)
+
+    trellis.maintain(initially=[])
+    def rows(self):
+        source, offset, limit = self.source, self.offset, self.limit
+        old = self.rows
+        if source is None:
+            new = []
+        else:
+            view = source, offset, limit
+            changes = source.changes
+            if view == self.old_view:
+                if not self.affected(changes, offset, offset+limit):
+                    return old
+            else:
+                self.old_view = view
+                old = None
+            new = source[offset:offset+limit]
+
+        if old is None:
+            self.changes = [(0, len(self.rows), len(new))]
+            return new
+
+        # Trim the unchanged rows from each end, leaving one changed region
+        size, start, end = min(len(old), len(new)), 0, 0
+        while start < size and old[start] is new[start]:
+            start += 1
+        while end < size-start and old[-end-1] is new[-end-1]:
+            end += 1
+        if start == len(old) == len(new):
+            return old
+        self.changes = [(start, len(old)-end, len(new)-start-end)]
+        return new
+
+    def affected(self, changes, start, stop):
+        """Can source `changes` alter the rows between `start` and `stop`?"""
+        shift = 0
+        for s, e, size in changes:
+            if e <= start:
+                shift += size - (e - s)     # rows inserted or deleted above
+            elif s < stop:
+                return True
+        return shift != 0
+
+
+class BoundedPipe(trellis.Component):
+    """Pipe whose items are kept in a fixed-size buffer for one or more readers
+
+    Each reader (created with ``reader()``) consumes items at its own pace.
+    ``space`` is the number of items that can be written before the slowest
+    reader's unconsumed items would be overwritten, and ``full`` is true when
+    there is no space left.  Writing to a full pipe is allowed, but readers
+    that fall more than ``capacity`` items behind will miss the oldest ones.
+    """
+
+    capacity = trellis.make(lambda self: 256)
+    readers = trellis.make(trellis.Set)
+
+    _pending = trellis.todo(list)
+    _input = _pending.future
+    _buffer = trellis.make(lambda self: [None] * self.capacity)
+
+    trellis.maintain(initially=0)
+    def written(self):
+        """The total number of items written to the pipe so far"""
+        written = self.written
+        pending = self._pending
+        if pending:
+            buffer, capacity = self._buffer, self.capacity
+            if len(pending) > capacity:
+                # only the last `capacity` items can survive
+                written += len(pending) - capacity
+                pending = pending[-capacity:]
+            for item in pending:
+                pos = written % capacity
+                trellis.on_undo(buffer.__setitem__, pos, buffer[pos])
+                buffer[pos] = item
+                written += 1
+        return written
+
+    trellis.maintain()
+    def space(self):
+        positions = [reader.position for reader in self.readers]
+        if not positions:
+            return self.capacity
+        return max(0, self.capacity - (self.written - min(positions)))
+
+    trellis.compute()
+    def full(self):
+        return not self.space
+
+    decorators.decorate(trellis.modifier)
+    def append(self, value):
+        self._input.append(value)
+
+    decorators.decorate(trellis.modifier)
+    def extend(self, sequence):
+        self._input.extend(sequence)
+
+    decorators.decorate(trellis.modifier)
+    def reader(self):
+        """Return a new ``PipeReader`` for items written from now on"""
+        reader = PipeReader(pipe=self, position=self.written)
+        self.readers.add(reader)
+        return reader
+
+    def _items(self, start, end):
+        buffer, capacity = self._buffer, self.capacity
+        for pos in xrange(start, end):
+            yield buffer[pos % capacity]
+
+
+class PipeReader(trellis.Component):
+    """A cursor over the unconsumed items of a ``BoundedPipe``
+
+    Iterating over a reader yields its unconsumed items straight from the
+    pipe's buffer, without copying them.  Items stay unconsumed (and keep
+    taking up space in the pipe) until ``consume()`` is called, either from a
+    modifier or from the rule that processed them.
+    """
+
+    pipe = trellis.attr(None)
+    position = trellis.attr(0)
+
+    trellis.compute()
+    def start(self):
+        """Position of the oldest item still in the pipe's buffer"""
+        pipe = self.pipe
+        return max(self.position, pipe.written - pipe.capacity)
+
+    trellis.compute()
+    def missed(self):
+        """Number of items overwritten before this reader consumed them"""
+        return self.start - self.position
+
+    def __len__(self):
+        return self.pipe.written - self.start
+
+    def __iter__(self):
+        return self.pipe._items(self.start, self.pipe.written)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    decorators.decorate(trellis.modifier)
+    def consume(self, count=None):
+        """Mark `count` (default: all) unconsumed items as read
+
+        The reader's position is updated once the current recalculation is
+        committed, so a rule can consume the items it just read without
+        creating a circular dependency on its own position.
+        """
+        end = self.pipe.written
+        if count is not None:
+            end = min(end, self.start + count)
+        trellis.on_commit(self._advance, end)
+
+    def _advance(self, end):
+        if end > self.position:
+            self.position = end
+
+    decorators.decorate(trellis.modifier)
+    def close(self):
+        """Stop reading, so the pipe no longer keeps items for this reader"""
+        self.pipe.readers.discard(self)
@@ -1,7 +1,8 @@
 from thread import get_ident
 from weakref import ref
 from peak.util import addons, decorators
-import sys, UserDict, UserList, sets, stm, types, new, weakref, copy
+import sys, UserDict, UserList, sets, stm, types, new, weakref, copy, cPickle
+from itertools import ifilter, ifilterfalse
 from peak.util.extremes import Max
 from peak.util.symbols import Symbol, NOT_GIVEN
 
@@ -10,7 +11,9 @@ __all__ = [
     'Component', 'repeat', 'poll', 'InputConflict',
     'Dict', 'List', 'Set', 'mark_dirty', 'ctrl', 'ConstantMixin', 'Sensor',
     'AbstractConnector', 'Connector',  'Effector', 'init_attrs',
+    'ConnectionPool', 'PooledConnector', 'WriteBack', 'WriteBackConnector',
     'attr', 'attrs', 'compute', 'maintain', 'perform', 'Performer', 'Pipe',
+    'snapshot', 'restore',
 ]
 
 NO_VALUE = Symbol('NO_VALUE', __name__)
@@ -195,7 +198,7 @@ class ReadOnlyCell(_ReadValue, stm.AbstractListener):
             on_commit(self._finish)
         else:
             value = self.rule()
-            if value!=self._value:
+            if value is not self._value and value!=self._value:
                 if self._set_by is _sentinel:
                     change_attr(self, '_set_by', self)
                     on_commit(self._finish)
@@ -408,6 +411,9 @@ class AbstractConnector(object):
     def disconnect(self, sensor, key):
         """Disconnect the key returned by ``connect()``"""
 
+    def write(self, effector, value):
+        """Called when `value` is assigned to an ``Effector`` using this"""
+
 class Connector(AbstractConnector):
     """Trivial connector, wrapping three functions"""
 
@@ -426,6 +432,148 @@ def noop():
     return ctrl.current_listener._value
 
 
+class ConnectionPool(object):
+    """Share one sensor per key among many rules, connecting keys in batches
+
+    ``pool[key]`` returns the (weakly cached) sensor for `key`, so every rule
+    that reads it shares a single upstream subscription.  When sensors gain
+    their first listener or lose their last one, the affected keys are handed
+    to ``connect_many(keys)`` or ``disconnect_many(keys)`` once per
+    recalculation, after it's committed.  The upstream source should then call
+    ``receive(key, value)`` or ``receive_many(items)`` to deliver new values.
+    """
+
+    def __init__(self, connect_many, disconnect_many):
+        self.connect_many = connect_many
+        self.disconnect_many = disconnect_many
+        self.sensors = WeakDefaultDict(self._make_sensor)
+        self.connected = {}     # {key: last received value}
+        self._changed = {}
+
+    def __getitem__(self, key):
+        return self.sensors[key]
+
+    def _make_sensor(self, key):
+        return Sensor(PooledConnector(self, key), self.connected.get(key))
+
+    def receive(self, key, value):
+        """Send `value` to the sensor for `key`, if it's connected"""
+        if key in self.connected:
+            self.connected[key] = value
+            sensor = self.sensors.get(key)
+            if sensor is not None:
+                sensor.receive(value)
+
+    decorators.decorate(modifier)
+    def receive_many(self, items):
+        """Send ``(key, value)`` pairs to their sensors in a single operation"""
+        for key, value in items:
+            self.receive(key, value)
+
+    def _touch(self, key):
+        if not self._changed:
+            on_commit(self._flush)
+        if key not in self._changed:
+            self._changed[key] = True
+            on_undo(self._changed.pop, key, None)
+
+    def _flush(self):
+        changed, self._changed = self._changed, {}
+        connect, disconnect = [], []
+        for key in changed:
+            sensor = self.sensors.get(key)
+            if sensor is not None and sensor.next_listener is not None:
+                if key not in self.connected:
+                    connect.append(key)
+            elif key in self.connected:
+                disconnect.append(key)
+        if disconnect:
+            for key in disconnect:
+                del self.connected[key]
+            self.disconnect_many(disconnect)
+        if connect:
+            for key in connect:
+                self.connected[key] = None
+            self.connect_many(connect)
+
+
+class PooledConnector(AbstractConnector):
+    """Connector for a ``ConnectionPool`` sensor"""
+
+    __slots__ = 'pool', 'key'
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+
+    def connect(self, sensor):
+        self.pool._touch(self.key)
+        return self.key
+
+    def disconnect(self, sensor, key):
+        self.pool._touch(key)
+
+
+
+class WriteBack(object):
+    """Collect the values written to Effectors, flushing them once per commit
+
+    Effectors built on ``connector(key)`` report every value assigned to them,
+    and when the recalculation that assigned them is committed, the last value
+    written for each key is passed (in order of first write) to a single
+    ``write_many(items)`` call as a list of ``(key, value)`` pairs.  Writes
+    that are rolled back are discarded, so nothing is sent for a failed
+    recalculation.
+    """
+
+    def __init__(self, write_many):
+        self.write_many = write_many
+        self.pending = {}   # {key: last value written}
+        self.order = []
+
+    def connector(self, key, read=None):
+        """Return a connector that writes back to `key`"""
+        return WriteBackConnector(self, key, read)
+
+    def write(self, key, value):
+        """Schedule `value` to be written to `key` when the recalc commits"""
+        if not ctrl.active:
+            return atomically(self.write, key, value)
+        manage(self)
+        pending = self.pending
+        if key in pending:
+            on_undo(pending.__setitem__, key, pending[key])
+        else:
+            self.order.append(key)
+            on_undo(self.order.pop)
+            on_undo(pending.pop, key)
+        pending[key] = value
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, typ, val, tb):
+        pending, order = self.pending, self.order
+        self.pending, self.order = {}, []
+        if typ is None and order:
+            self.write_many([(key, pending[key]) for key in order])
+
+
+class WriteBackConnector(AbstractConnector):
+    """Connector for an ``Effector`` whose writes are batched by a WriteBack"""
+
+    __slots__ = 'writeback', 'key', 'read'
+
+    def __init__(self, writeback, key, read=None):
+        if read is None:
+            read = noop
+        self.writeback = writeback
+        self.key = key
+        self.read = read
+
+    def write(self, effector, value):
+        self.writeback.write(self.key, value)
+
 
 class LazyConnector(AbstractConnector):
     """Dummy connector object used for lazy cells"""
@@ -560,6 +708,16 @@ class Effector(SensorBase, Cell):
 
     __slots__ = 'connector', 'listening'
 
+    def set_value(self, value):
+        if not ctrl.active:
+            return atomically(self.set_value, value)
+        old = self._value
+        super(Effector, self).set_value(value)
+        if self.connector is not None and value is not old and value != old:
+            self.connector.write(self, value)
+
+    value = property(Cell.get_value.im_func, set_value)
+
 
 
 
@@ -631,6 +789,34 @@ class Component(decorators.classy):
                     c.value     # XXX
         return rv
 
+    decorators.decorate(classmethod, modifier)
+    def create_many(cls, rows):
+        """Create one instance per keyword dict in `rows`, atomically
+
+        Cell factories are looked up once for the whole batch, and the new
+        instances' non-optional rules are scheduled to initialize together in
+        a single pass, once all the instances exist.
+        """
+        if ctrl.readonly and ctrl.newcells is None:
+            return ctrl.with_new(Component.create_many.im_func, cls, rows)
+        required = _required_cells(cls)
+        new = super(Component, cls).__class_call__
+        if getattr(cls.__init__, 'im_func', None) is init_attrs:
+            # Nobody can have seen the new instances yet, so plain values can
+            # go straight into new Value cells, skipping a transactional set
+            plain = _plain_values(cls)
+            obs = []
+            for kw in rows:
+                ob = new()
+                _init_values(ob, kw, plain)
+                obs.append(ob)
+        else:
+            obs = [new(**kw) for kw in rows]
+        for ob in obs:
+            if isinstance(ob, cls):
+                _schedule_cells(cls, ob, required)
+        return obs
+
     __init__ = init_attrs
 
     decorators.decorate(staticmethod)
@@ -654,6 +840,44 @@ class Component(decorators.classy):
                 optional[k] = True
 
 
+def _required_cells(cls):
+    """List ``(name, factory)`` pairs for `cls`'s non-optional cells"""
+    factories = CellFactories(cls)
+    return [(k, factories[k]) for k, v in IsOptional(cls).items() if not v]
+
+def _plain_values(cls):
+    """Return a dictionary of `cls`'s plain, non-discrete ``attr()`` names"""
+    plain = {}
+    for k in CellFactories(cls):
+        descr = getattr(cls, k, None)
+        if (isinstance(descr, CellAttribute) and descr.factory is Cell
+            and descr.rule is None and descr.connect is None
+            and not descr.discrete
+        ):
+            plain[k] = True
+    return plain
+
+def _init_values(ob, kw, plain):
+    """Like ``init_attrs()``, but with fresh ``Value`` cells for `plain` names"""
+    cells = Cells(ob)
+    rest = {}
+    for k, v in kw.iteritems():
+        if k in plain and k not in cells and not isinstance(v, AbstractCell):
+            cells[k] = Value(v)
+        else:
+            rest[k] = v
+    init_attrs(ob, **rest)
+
+def _schedule_cells(cls, ob, required):
+    """Create `ob`'s missing `required` cells, scheduling uninitialized ones"""
+    cells = Cells(ob)
+    for k, factory in required:
+        if k not in cells:
+            c = cells.setdefault(k, factory(cls, ob, k))
+            if c._needs_init:
+                schedule(c)
+
+
 def repeat():
     """Schedule the current rule to be run again, repeatedly"""
     if ctrl.current_listener is not None:
@@ -937,13 +1161,23 @@ def todos(**attrs):
     """Define multiple todo-cell attributes"""
     _make_multi(sys._getframe(1), attrs, TodoProperty.mkattr)
 
-def todo(rule=None):
-    """Define an attribute that can send "messages to the future" """
-    return _build_descriptor(rule=rule, __proptype = TodoProperty.mkattr)
+def todo(rule=None, copy=None):
+    """Define an attribute that can send "messages to the future"
+
+    If `copy` is given, it is used instead of ``copy.copy()`` to duplicate the
+    future value when more than one rule or modifier writes to it in the same
+    pulse.  Structures with a cheap (e.g. structurally-shared) copy operation
+    can use it to avoid paying for the entries a pulse doesn't touch.
+    """
+    return _build_descriptor(
+        rule=rule, copy=copy, __proptype = TodoProperty.mkattr
+    )
 
 class TodoProperty(CellAttribute):
     """Property representing a ``todo`` attribute"""
 
+    copy = None
+
     decorators.decorate(property)
     def future(self):
         """Get a read-only property for the "future" of this attribute"""
@@ -960,7 +1194,9 @@ class TodoProperty(CellAttribute):
         return property(get, doc="The future value of the %r attribute" % name)
 
     def factory(self, rule, value, discrete):
-        return TodoValue(rule)
+        if self.copy is None:
+            return TodoValue(rule)
+        return TodoValue(rule, self.copy)
 
 def build_value(make, ob, name):
     if hasattr(make, '__get__'):
@@ -1008,6 +1244,7 @@ class TodoValue(Value):
             else:
                 value = self._copy(self._value)
                 change_attr(self, '_value', value)
+                changed(self)
             change_attr(self, '_last_reader', ctrl.current_listener)
         return self._value
 
@@ -1105,6 +1342,50 @@ def cellcache(rule=None, make=None, initially=NO_VALUE, resetting_to=NO_VALUE):
         __proptype = CacheAttr.mkattr
     )
     
+class _KeySubject(stm.AbstractSubject):
+    """Dependency target for rules that read a single key of a collection"""
+
+    __slots__ = 'next_listener', '__weakref__'
+
+    def __init__(self, key=None):
+        stm.AbstractSubject.__init__(self)
+
+def _read_key(ob, name, key):
+    """Return `ob`'s `name` data, depending only on `key` if called by a rule
+
+    The data cell's value is returned as-is (i.e. without a dependency on the
+    cell), so `name` must be a rule that updates its data in place and calls
+    ``_keys_changed()`` for the keys whose presence or values it changes.
+    """
+    if ctrl.current_listener is None:
+        return getattr(ob, name)
+    try:
+        subjects = ob.__dict__['_subjects']
+    except KeyError:
+        subjects = ob.__dict__['_subjects'] = WeakDefaultDict(_KeySubject)
+    used(subjects[key])
+    return ob.__cells__[name]._value
+
+def _keys_changed(ob, *keysets):
+    """Notify the rules that used ``_read_key()`` to read any of `keysets`"""
+    subjects = ob.__dict__.get('_subjects')
+    if subjects:
+        if len(subjects) < sum(map(len, keysets)):
+            for key in subjects.keys():
+                for keys in keysets:
+                    if key in keys:
+                        subject = subjects.get(key)
+                        if subject is not None:
+                            changed(subject)
+                        break
+        else:
+            for keys in keysets:
+                for key in keys:
+                    subject = subjects.get(key)
+                    if subject is not None:
+                        changed(subject)
+
+
 class Dict(UserDict.IterableUserDict, Component):
     """Dictionary-like object that recalculates observers when it's changed
 
@@ -1114,9 +1395,11 @@ class Dict(UserDict.IterableUserDict, Component):
     same value as they had in the previous recalc, as no value comparisons are
     done!
 
-    You may observe these attributes directly, but any rule that reads the
-    dictionary in any way (e.g. gets items, iterates, checks length, etc.)
-    will be recalculated if the dictionary is changed in any way.
+    You may observe these attributes directly.  A rule that only looks up
+    individual keys (using ``[]``, ``get()``, ``in``, or ``has_key()``) will
+    only be recalculated when one of those keys is added, changed, or deleted,
+    but any rule that reads the dictionary in any other way (e.g. iterates,
+    checks length, etc.) will be recalculated if it's changed in any way.
 
     Note that this operations like pop(), popitem(), and setdefault() that both
     read and write in the same operation are NOT supported, since reading must
@@ -1139,8 +1422,21 @@ class Dict(UserDict.IterableUserDict, Component):
     def copy(self):
         return self.__class__(self.data)
 
+    def __getitem__(self, key):
+        data = _read_key(self, 'data', key)
+        if key in data:
+            return data[key]
+        if hasattr(self.__class__, "__missing__"):
+            return self.__missing__(key)
+        raise KeyError(key)
+
     def get(self, key, failobj=None):
-        return self.data.get(key, failobj)
+        return _read_key(self, 'data', key).get(key, failobj)
+
+    def __contains__(self, key):
+        return key in _read_key(self, 'data', key)
+
+    has_key = __contains__
 
     def __hash__(self):
         raise TypeError
@@ -1163,6 +1459,7 @@ class Dict(UserDict.IterableUserDict, Component):
             mark_dirty(); data.update(self.added)
         if self.changed:
             mark_dirty(); data.update(self.changed)
+        _keys_changed(self, self.deleted, self.added, self.changed)
         return data
 
     decorators.decorate(modifier)
@@ -1228,6 +1525,90 @@ class Dict(UserDict.IterableUserDict, Component):
 
 
 
+class _Splices(list):
+    """Ordered log of ``(start, end, items)`` splices to a list"""
+
+    __slots__ = 'base', 'size'
+
+    def __init__(self, base):
+        self.base = base
+        self.size = len(base)
+
+    def copy(self):
+        log = _Splices(self.base)
+        log[:] = self
+        log.size = self.size
+        return log
+
+
+class _Future(list):
+    """Copy of a List's future contents that passes its changes to the List"""
+
+    __slots__ = 'owner'
+
+    def __init__(self, owner, data):
+        list.__init__(self, data)
+        self.owner = owner
+
+    def __setitem__(self, i, item):
+        if isinstance(i, slice):
+            item = list(item)
+        list.__setitem__(self, i, item)
+        self.owner[i] = item
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        del self.owner[i]
+
+    def __setslice__(self, i, j, other):
+        other = list(other)
+        list.__setslice__(self, i, j, other)
+        self.owner[i:j] = other
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        del self.owner[i:j]
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self.owner *= n
+        return self
+
+    def append(self, item):
+        list.append(self, item)
+        self.owner.append(item)
+
+    def insert(self, i, item):
+        list.insert(self, i, item)
+        self.owner.insert(i, item)
+
+    def extend(self, other):
+        other = list(other)
+        list.extend(self, other)
+        self.owner.extend(other)
+
+    def pop(self, i=-1):
+        item = list.pop(self, i)
+        del self.owner[i]
+        return item
+
+    def remove(self, item):
+        list.remove(self, item)
+        self.owner.remove(item)
+
+    def reverse(self):
+        list.reverse(self)
+        self.owner.reverse()
+
+    def sort(self, *args, **kw):
+        list.sort(self, *args, **kw)
+        self.owner[:] = self
+
+
 class List(UserList.UserList, Component):
     """List-like object that recalculates observers when it's changed
 
@@ -1236,13 +1617,16 @@ class List(UserList.UserList, Component):
     gets items, iterates, checks length, etc.) will be recalculated if the
     list is changed in any way.
 
-    Note that this type is not efficient for large lists, as a copy-on-write
-    strategy is used in each recalcultion that changes the list.  If what you
-    really want is e.g. a sorted read-only view on a set, don't use this.
+    The ``changes`` attribute lists the ``(start, end, items)`` splices made
+    to the list in the current recalculation, in the order they were made:
+    applying ``old[start:end] = items`` for each one turns the old contents
+    into the new ones.  Only the spliced regions are updated, but operations
+    that affect the whole list (``sort()``, ``reverse()``, and extended-slice
+    changes) are logged as a single whole-list splice.
     """
 
-    updated = todo(lambda self: self.data[:])
-    future  = updated.future
+    changes = todo(lambda self: _Splices(self.data), copy=_Splices.copy)
+    to_splice = changes.future
     changed = todo(bool)
 
     def __init__(self, other=(), **kw):
@@ -1251,79 +1635,132 @@ class List(UserList.UserList, Component):
 
     maintain(make=list)
     def data(self):
-        if self.changed:
+        data = self.data
+        if self.changes:
             mark_dirty()
-            return self.updated
-        return self.data
+            for start, end, items in self.changes:
+                old = data[start:end]
+                on_undo(data.__setslice__, start, start+len(items), old)
+                data[start:end] = items
+        return data
 
-    decorators.decorate(modifier)
-    def __setitem__(self, i, item):
+    def _splice(self, start, end, items):
         self.changed = True
-        self.future[i] = item
+        log = self.to_splice
+        log.append((start, end, items))
+        log.size += len(items) - (end - start)
+
+    def _pending(self):
+        """Return a plain copy of the list's contents after pending changes"""
+        log = self.to_splice
+        data = log.base[:]
+        for start, end, items in log:
+            data[start:end] = items
+        return data
 
-    decorators.decorate(modifier)
-    def __delitem__(self, i):
-        self.changed = True
-        del self.future[i]
+    decorators.decorate(property)
+    def future(self):
+        """The list's contents as of the next recalculation
+
+        This is a copy, but changing it changes the list in the same way.
+        """
+        return _Future(self, self._pending())
 
+    updated = compute(lambda self: self.data[:])
 
+    def _rewrite(self, data):
+        self._splice(0, self.to_splice.size, data)
 
+    def _index(self, i):
+        size = self.to_splice.size
+        if i < 0:
+            i += size
+        if not 0 <= i < size:
+            raise IndexError("list assignment index out of range")
+        return i
+
+    decorators.decorate(modifier)
+    def __setitem__(self, i, item):
+        if isinstance(i, slice):
+            data = self._pending()
+            data[i] = item
+            self._rewrite(data)
+        else:
+            i = self._index(i)
+            self._splice(i, i+1, [item])
+
+    decorators.decorate(modifier)
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            data = self._pending()
+            del data[i]
+            self._rewrite(data)
+        else:
+            i = self._index(i)
+            self._splice(i, i+1, [])
 
     decorators.decorate(modifier)
     def __setslice__(self, i, j, other):
-        self.changed = True
-        self.future[i:j] = other
+        size = self.to_splice.size
+        i = max(0, min(i, size))
+        self._splice(i, max(i, min(j, size)), list(other))
 
     decorators.decorate(modifier)
     def __delslice__(self, i, j):
-        self.changed = True
-        del self.future[i:j]
+        self.__setslice__(i, j, [])
 
     decorators.decorate(modifier)
     def __iadd__(self, other):
-        self.changed = True
-        self.future.extend(other)
+        self.extend(other)
         return self
 
     decorators.decorate(modifier)
     def append(self, item):
-        self.changed = True
-        self.future.append(item)
+        size = self.to_splice.size
+        self._splice(size, size, [item])
 
     decorators.decorate(modifier)
     def insert(self, i, item):
-        self.changed = True
-        self.future.insert(i, item)
+        size = self.to_splice.size
+        if i < 0:
+            i = max(0, i + size)
+        i = min(i, size)
+        self._splice(i, i, [item])
 
     decorators.decorate(modifier)
     def extend(self, other):
-        self.changed = True
-        self.future.extend(other)
+        size = self.to_splice.size
+        self._splice(size, size, list(other))
 
     decorators.decorate(modifier)
     def __imul__(self, n):
-        self.changed = True
-        self.future[:] = self.future * n
+        size = self.to_splice.size
+        if n <= 0:
+            self._splice(0, size, [])
+        else:
+            self._splice(size, size, self._pending() * (n-1))
         return self
 
-
-
-
-
     decorators.decorate(modifier)
     def remove(self, item):
-        self.changed = True
-        self.future.remove(item)
+        data = self._pending()
+        try:
+            i = data.index(item)
+        except ValueError:
+            raise ValueError("list.remove(x): x not in list")
+        self._splice(i, i+1, [])
 
     decorators.decorate(modifier)
     def reverse(self):
-        self.changed = True
-        self.future.reverse()
+        data = self._pending()
+        data.reverse()
+        self._rewrite(data)
 
     decorators.decorate(modifier)
     def sort(self, *args, **kw):
-        self.changed = True
-        self.future.sort(*args, **kw)
+        data = self._pending()
+        data.sort(*args, **kw)
+        self._rewrite(data)
 
     def pop(self, i=-1):
         """The pop() method isn't supported, because it 'reads the future'"""
@@ -1354,9 +1791,11 @@ class List(UserList.UserList, Component):
 class Set(sets.Set, Component):
     """Mutable set that recalculates observers when it's changed
 
-    The ``added`` and ``removed`` attributes can be watched for changes, but
-    any rule that simply uses the set (e.g. iterates over it, checks for
-    membership or size, etc.) will be recalculated if the set is changed.
+    The ``added`` and ``removed`` attributes can be watched for changes.  A
+    rule that checks for membership (using ``in``) will only be recalculated
+    when one of the items it checked is added or removed, but any rule that
+    uses the set in any other way (e.g. iterates over it, checks its size,
+    etc.) will be recalculated if the set is changed.
     """
     _added = todo(set)
     _removed = todo(set)
@@ -1375,20 +1814,31 @@ class Set(sets.Set, Component):
     def _data(self):
         """The dictionary containing the set data."""
         data = self._data
-        pop = data.pop
-        if self.removed:
+        removed, added = self.removed, self.added
+        if removed:
             mark_dirty()
-            for item in self.removed: pop(item, None)
-            on_undo(data.update, dict.fromkeys(self.removed, True))
-        if self.added:
+            pop = data.pop
+            removed = set([item for item in removed if pop(item, None)])
+            on_undo(data.update, dict.fromkeys(removed, True))
+        if added:
             mark_dirty()
-            data.update(dict.fromkeys(self.added, True))
-            for item in self.added: on_undo(pop, item, None)
+            data.update(dict.fromkeys(added, True))
+            on_undo(map, data.__delitem__, added)
+        _keys_changed(self, removed, added)
         return data
 
     def __setstate__(self, data):
         self.__init__(data[0])
 
+    def __contains__(self, element):
+        try:
+            return element in _read_key(self, '_data', element)
+        except TypeError:
+            transform = getattr(element, "__as_temporarily_immutable__", None)
+            if transform is None:
+                raise # re-raise the TypeError exception we caught
+            return transform() in self
+
 
 
 
@@ -1406,13 +1856,9 @@ class Set(sets.Set, Component):
 
     decorators.decorate(modifier)
     def _update(self, iterable):
-        to_remove = self.to_remove
-        add = self.to_add.add
-        for item in iterable:
-            if item in to_remove:
-                to_remove.remove(item)
-            else:
-                add(item)
+        items = set(iterable)
+        self.to_remove.difference_update(items)
+        self.to_add.update(items.difference(self._data))
 
     decorators.decorate(modifier)
     def add(self, item):
@@ -1454,22 +1900,16 @@ class Set(sets.Set, Component):
     decorators.decorate(modifier)
     def difference_update(self, other):
         """Remove all elements of another set from this set."""
-        data = self._data
-        to_add, to_remove = self.to_add, self.to_remove
-        for item in other:
-            if item in to_add: to_add.remove(item)
-            elif item in data: to_remove.add(item)
+        items = set(other)
+        self.to_add.difference_update(items)
+        self.to_remove.update(ifilter(self._data.__contains__, items))
 
     decorators.decorate(modifier)
     def intersection_update(self, other):
         """Update a set with the intersection of itself and another."""
-        to_remove = self.to_remove
-        to_add = self.to_add
-        self.to_add.intersection_update(other)
         other = to_dict_or_set(other)
-        for item in self._data:
-            if item not in other:
-                to_remove.add(item)
+        self.to_add.intersection_update(other)
+        self.to_remove.update(ifilterfalse(other.__contains__, self._data))
         return self
 
 
@@ -1477,18 +1917,17 @@ class Set(sets.Set, Component):
     decorators.decorate(modifier)
     def symmetric_difference_update(self, other):
         """Update a set with the symmetric difference of itself and another."""
-        data = self._data
+        items = set(other)
         to_add = self.to_add
         to_remove = self.to_remove
-        for elt in to_dict_or_set(other):
-            if elt in to_add:
-                to_add.remove(elt)      # Got it; get rid of it
-            elif elt in to_remove:
-                to_remove.remove(elt)   # Don't got it; add it
-            elif elt in data:
-                to_remove.add(elt)      # Got it; get rid of it
-            else:
-                to_add.add(elt)         # Don't got it; add it
+        pending = items & to_add        # Got it; get rid of it
+        unremove = items & to_remove    # Don't got it; add it
+        items -= pending; items -= unremove
+        present = set(ifilter(self._data.__contains__, items))
+        to_add -= pending
+        to_remove -= unremove
+        to_remove |= present            # Got it; get rid of it
+        to_add |= items - present       # Don't got it; add it
 
 def to_dict_or_set(ob):
     """Return the most basic set or dict-like object for ob
@@ -1503,6 +1942,181 @@ def to_dict_or_set(ob):
 
 
 
+def snapshot(obs, stream, protocol=-1):
+    """Save the committed cell values of components `obs` to `stream`
+
+    Any components referenced by the saved values are saved as well.  Values
+    are pickled, along with the dependency links between the saved rule
+    cells, so that ``restore()`` can rebuild the components without running
+    their rules again.  Performers, sensors, tasks, ``@compute`` rules and
+    cell caches are not saved; they're recreated as needed after a restore.
+    """
+    assert not ctrl.active, "Can't snapshot during an atomic operation"
+    index = {}      # id(component) -> position in `found`
+    found = []
+    def persistent_id(ob):
+        if isinstance(ob, Component):
+            key = id(ob)
+            if key not in index:
+                index[key] = len(found)
+                found.append(ob)
+            return index[key], type(ob)
+        elif isinstance(ob, AbstractCell):
+            raise TypeError("Can't snapshot a cell outside a component", ob)
+
+    pickler = cPickle.Pickler(stream, protocol)
+    pickler.persistent_id = persistent_id
+    pickler.dump(list(obs))
+
+    owners = {}     # id(cell) -> (position, name)
+    rules = []
+    pos = 0
+    while pos < len(found):
+        # Save everything found so far in one batch; pickling the batch may
+        # then find more components to save in the next one
+        batch = []
+        for pos in range(pos, len(found)):
+            batch.append((pos,) + _cell_state(found[pos], pos, owners, rules))
+        pickler.dump(batch)
+        pos += 1
+    pickler.dump(None)
+
+    deps = []
+    for key, cell in rules:
+        deps.append((key, [owners.get(id(s)) for s in cell.iter_subjects()]))
+    pickler.dump(deps)
+
+
+def _cell_state(ob, pos, owners, rules):
+    """Return the ``(attrs, state)`` that ``snapshot()`` saves for `ob`"""
+    cls = type(ob)
+    attrs = dict([
+        (k, v) for k, v in getattr(ob, '__dict__', {}).items()
+        if k != '__cells__' and isinstance(k, str)
+        and not isinstance(v, WeakDefaultDict)     # caches are rebuilt on demand
+    ])
+    state = {}
+    for name, cell in Cells(ob).items():
+        if id(cell) in owners:
+            state[name] = 'alias', owners[id(cell)]
+            continue
+        elif isinstance(cell, (SensorBase, Performer)):
+            continue
+        elif isinstance(cell, ConstantMixin):
+            if isinstance(getattr(cls, name, None), CacheAttr):
+                continue
+            state[name] = 'const', cell.value
+        elif isinstance(cell, TodoValue) or type(cell) is Value and (
+            cell._value is getattr(getattr(cls, name, None), 'value', None)
+        ):
+            state[name] = 'new',     # just recreate it from the attribute
+        elif type(cell) is Value:
+            state[name] = 'value', cell._value, cell._reset is not _sentinel
+        elif type(cell) in (ReadOnlyCell, Cell) and not cell._needs_init:
+            if cell._reset is _sentinel:
+                value, discrete = cell._value, False
+            else:
+                value, discrete = cell._reset, True
+            state[name] = type(cell), value, discrete, cell.layer
+            rules.append(((pos, name), cell))
+        else:
+            continue
+        owners[id(cell)] = pos, name
+    return attrs, state
+
+
+def restore(stream):
+    """Load components saved by ``snapshot()``, returning the saved list
+
+    Rule cells are restored with their saved values and dependencies instead
+    of being recalculated, unless they depended on something that couldn't be
+    saved.  Any such rules (along with all other non-optional cells that
+    weren't saved, such as performers) are then initialized in a single atomic
+    operation, just as they would be for a newly-created component.
+    """
+    assert not ctrl.active, "Can't restore during an atomic operation"
+    obs = {}
+    def persistent_load(pid):
+        pos, cls = pid
+        if pos not in obs:
+            obs[pos] = cls.__new__(cls)
+        return obs[pos]
+
+    unpickler = cPickle.Unpickler(stream)
+    unpickler.persistent_load = persistent_load
+    roots = unpickler.load()
+
+    restored = {}   # (position, name) -> cell
+    aliases = []
+    batch = unpickler.load()
+    while batch is not None:
+        for pos, attrs, state in batch:
+            ob = obs[pos]
+            cls = type(ob)
+            ob.__dict__.update(attrs)
+            cells = Cells(ob)
+            for name, info in state.items():
+                kind = info[0]
+                if kind == 'alias':
+                    aliases.append((cells, name, info[1]))
+                    continue
+                elif kind == 'const':
+                    cell = Constant(info[1])
+                elif kind == 'new':
+                    cell = CellFactories(cls)[name](cls, ob, name)
+                elif kind == 'value':
+                    cell = Value(info[1], info[2])
+                else:
+                    kind, value, discrete, layer = info
+                    rule = bind(getattr(cls, name).rule, ob, cls)
+                    cell = kind(rule, value, discrete)
+                    cell._needs_init = False
+                    cell.layer = layer
+                cells[name] = restored[pos, name] = cell
+        batch = unpickler.load()
+    deps = unpickler.load()
+
+    # Rules that used anything we couldn't restore have to be recalculated,
+    # and so do any restored rules that depend on them
+    listeners = {}
+    bad = []
+    for key, subjects in deps:
+        for subject in subjects:
+            if subject in restored:
+                listeners.setdefault(subject, []).append(key)
+            else:
+                bad.append(key)
+    dropped = {}
+    while bad:
+        key = bad.pop()
+        if key not in dropped:
+            dropped[key] = True
+            del Cells(obs[key[0]])[key[1]]
+            bad.extend(listeners.get(key, ()))
+
+    for key, subjects in deps:
+        if key not in dropped:
+            listener = restored[key]
+            for subject in subjects:
+                stm.Link(restored[subject], listener)
+
+    for cells, name, (pos, target) in aliases:
+        target = Cells(obs[pos]).get(target)
+        if target is not None:
+            cells[name] = target
+
+    def activate():
+        required = {}
+        for ob in obs.values():
+            cls = type(ob)
+            if cls not in required:
+                required[cls] = _required_cells(cls)
+            _schedule_cells(cls, ob, required[cls])
+    atomically(activate)
+    return roots
+
+
+
 
 
 
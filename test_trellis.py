@@ -14,6 +14,13 @@ try:
     import wx
 except ImportError:
     wx = None
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
 
 class EventLoopTestCase(unittest.TestCase):
     def setUp(self):
@@ -75,10 +82,205 @@ if wx:
             # XXX this should test more timing stuff, but the only way to do it
             #     is with a wx mock, which I haven't time for as yet.
 
+if asyncio:
+    class TestAsyncioEventLoop(EventLoopTestCase):
+        def configure_context(self):
+            from peak.events.activity import EventLoop, AsyncioEventLoop
+            EventLoop <<= AsyncioEventLoop
+
+        def testSequentialCalls(self):
+            log = []
+            EventLoop.call(log.append, 1)
+            EventLoop.call(log.append, 2)
+            EventLoop.call(log.append, 3)
+            event = Time[0.01]
+            def c():
+                if event:
+                    EventLoop.call(EventLoop.stop)
+            c = trellis.Cell(c)
+            c.value
+
+            # The loop sleeps until the timer is due, then stops
+            EventLoop.run()
+            self.assertEqual(log, [1,2,3])
+            self.failUnless(event)
+
+
+
+
+
+
+class FakeAsyncioLoop(object):
+    """Just enough of an asyncio event loop to run an AsyncioEventLoop"""
+
+    def __init__(self):
+        self.ready, self.timers, self.handles = [], [], []
+        self.stopped = False
+
+    def time(self):
+        import time
+        return time.time()
+
+    def call_soon_threadsafe(self, func, *args):
+        self.ready.append((func, args))
+
+    def call_at(self, when, func, *args):
+        handle = FakeAsyncioHandle(when, func, args)
+        self.timers.append(handle)
+        self.handles.append(handle)
+        return handle
+
+    def stop(self):
+        self.stopped = True
+
+    def run_forever(self):
+        import time
+        self.stopped = False
+        while not self.stopped:
+            self.timers = [h for h in self.timers if not h.cancelled]
+            if self.ready:
+                func, args = self.ready.pop(0)
+            elif self.timers:
+                handle = min(self.timers, key=lambda h: h.when)
+                self.timers.remove(handle)
+                time.sleep(max(0, handle.when - self.time()))
+                func, args = handle.func, handle.args
+            else:
+                raise AssertionError("loop would block forever")
+            func(*args)
+
+class FakeAsyncioHandle(object):
+    cancelled = False
+    def __init__(self, when, func, args):
+        self.when, self.func, self.args = when, func, args
+    def cancel(self):
+        self.cancelled = True
+
+class TestFakeAsyncioEventLoop(EventLoopTestCase):
+    def configure_context(self):
+        from peak.events.activity import EventLoop, AsyncioEventLoop
+        EventLoop <<= AsyncioEventLoop
+        EventLoop.get().loop = self.fake = FakeAsyncioLoop()
+
+    def testSequentialCalls(self):
+        log = []
+        EventLoop.call(log.append, 1)
+        EventLoop.call(log.append, 2)
+        EventLoop.call(log.append, 3)
+        event = Time[0.01]
+        def c():
+            if event:
+                EventLoop.call(EventLoop.stop)
+        c = trellis.Cell(c)
+        c.value
+
+        # The loop sleeps until the timer is due, then stops
+        EventLoop.run()
+        self.assertEqual(log, [1,2,3])
+        self.failUnless(event)
+        self.failIf(EventLoop.running)
+        self.assertEqual(self.fake.ready, [])
+        self.failUnless(self.fake.handles)  # it waited for a timer, not polled
+
 
+class TestSelectEventLoop(EventLoopTestCase):
+    def configure_context(self):
+        from peak.events.activity import EventLoop, SelectEventLoop
+        EventLoop <<= SelectEventLoop
+
+    def testReceived(self):
+        import socket
+        a, b = socket.socketpair()
+        log = []
+        def reader():
+            data = EventLoop.received(b)
+            if data is not None:
+                log.append(data.tobytes())
+                if not data:
+                    EventLoop.call(EventLoop.stop)
+        reader = trellis.Cell(reader)
+        reader.value
+        EventLoop.call(a.send, 'hello')
+        EventLoop.call(a.close)
+        EventLoop.run()
+        self.assertEqual(log, ['hello', ''])
+        b.close()
 
+class TestVirtualEventLoop(EventLoopTestCase):
+    def configure_context(self):
+        from peak.events.activity import EventLoop, VirtualEventLoop
+        EventLoop <<= VirtualEventLoop
+
+    def testJumpToEvents(self):
+        log = []
+        start = Time[0]
+        def sleeper():
+            for i in range(2):
+                t = Time[10]
+                while not Time.reached(t):
+                    yield activity.Pause
+                log.append(('woke', Time[0] - start))
+        activity.TaskCell(sleeper)
+        EventLoop.call_later(15, lambda: log.append(('input', Time[0]-start)))
+        EventLoop.run()
+        self.assertEqual(log, [('woke', 10), ('input', 15), ('woke', 20)])
+        self.assertEqual(EventLoop.run_stats['virtual_time'], 20)
+        self.assertEqual(EventLoop.run_stats['jumps'], 3)
+        self.failIf(EventLoop.running)
+
+    def testWaitForFuture(self):
+        import threading
+        callbacks, waits = [], []
+        class Later(object):
+            def add_done_callback(self, cb):
+                callbacks.append(cb)
+                threading.Timer(1, self.finish).start()    # just in case
+            def finish(self):
+                while callbacks:
+                    callbacks.pop()(self)
+            def result(self):
+                return 42
+        future = Later()
+        class Wakeup(object):
+            # finish the future when the loop waits, as another thread would
+            def __init__(self):
+                self.event = threading.Event()
+                self.set, self.clear = self.event.set, self.event.clear
+            def wait(self, timeout=None):
+                waits.append(timeout)
+                future.finish()
+                return self.event.wait(timeout)
+        class WaitingLoop(activity.VirtualEventLoop):
+            _wakeup = trellis.make(lambda self: Wakeup(), optional=False)
+        activity.EventLoop <<= WaitingLoop
+        log = []
+        def f():
+            yield future; log.append(activity.resume())
+        activity.TaskCell(f)
+        EventLoop.run()
+        self.assertEqual(log, [42])
+        self.assertEqual(waits, [None])     # slept until the future was done
 
+    def testCallLaterUndo(self):
+        log = []
+        def schedule_and_fail():
+            EventLoop.call_later(5, log.append, 5)
+            raise DummyError
+        self.assertRaises(DummyError, trellis.atomically, schedule_and_fail)
+        EventLoop.call_later(10, log.append, 10)
+        EventLoop.run()
+        self.assertEqual(log, [10])
+        self.assertEqual(EventLoop.run_stats['jumps'], 1)
 
+    def testDuration(self):
+        log = []
+        for delay in 5, 50:
+            EventLoop.call_later(delay, log.append, delay)
+        EventLoop.run(30)
+        self.assertEqual(log, [5])
+        self.assertEqual(EventLoop.run_stats['virtual_time'], 30)
+        EventLoop.run()
+        self.assertEqual(log, [5, 50])
 
 if testreactor:
 
@@ -980,6 +1182,62 @@ class TestCells(mocker.MockerTestCase):
         self.ctrl.rollback_to(sp)
         self.assertEqual(list(s.added), [1])
 
+    def testDictKeyDependencies(self):
+        d = trellis.Dict(a=1, b=2)
+        log = []
+        p = trellis.Performer(lambda: log.append((d['a'], 'c' in d)))
+        self.assertEqual(log, [(1, False)])
+        d['b'] = 3
+        self.assertEqual(log, [(1, False)])
+        d['a'] = 4
+        self.assertEqual(log, [(1, False), (4, False)])
+        d['c'] = 5
+        self.assertEqual(log, [(1, False), (4, False), (4, True)])
+        # a rule writing a key in the same pulse that another rule reads it
+        src = trellis.Value(0)
+        def write(): d['a'] = src.value
+        w = trellis.Cell(write)
+        w.value
+        src.value = 42
+        self.assertEqual(log[-1], (42, True))
+        self.assertEqual(d['a'], 42)
+
+    def testPipeWrittenByRuleAfterRead(self):
+        p = trellis.Pipe()
+        src = trellis.Value(0)
+        log = []
+        reader = trellis.Cell(lambda: log.append(list(p)))
+        reader.value
+        def forward():
+            if src.value: p.append(src.value)
+        writer = trellis.Cell(forward)
+        writer.value
+        def both():
+            p.append(1)
+            src.value = 2
+        trellis.modifier(both)()
+        self.assertEqual(log[-2], [1, 2])
+
+    def testSetMemberDependencies(self):
+        s = trellis.Set([1, 2])
+        log = []
+        p = trellis.Performer(lambda: log.append((1 in s, 3 in s)))
+        self.assertEqual(log, [(True, False)])
+        s.add(4); s.remove(2)
+        self.assertEqual(log, [(True, False)])
+        s.symmetric_difference_update([1, 3])
+        self.assertEqual(log, [(True, False), (False, True)])
+        s.difference_update([3, 4])
+        self.assertEqual(log[-1], (False, False))
+        self.assertEqual(list(s), [])
+
+    def testSetRemovesMissingItems(self):
+        s = trellis.Set([1, 2])
+        def remove_missing():
+            s.to_remove.update([2, 3])
+        trellis.modifier(remove_missing)()
+        self.assertEqual(list(s), [1])
+
 
 
     def testSetAfterSchedule(self):
@@ -1269,6 +1527,59 @@ class TestDefaultEventLoop(unittest.TestCase):
 
 
 
+    def testBatchedFlush(self):
+        log = []
+        v = trellis.Value(0)
+        d(trellis.Performer)
+        def watch():
+            log.append(v.value)
+        def inc():
+            v.value += 1
+        self.loop.batch_size = 2
+        for i in range(5):
+            self.loop.call(inc)
+        self.assertEqual(self.loop.queue_depth, 5)
+        self.loop.flush()
+        self.assertEqual(log, [0, 2, 4, 5])
+        self.assertEqual(self.loop.queue_depth, 0)
+        self.assertEqual(self.loop.max_depth, 5)
+        self.assertEqual(self.loop.calls_run, 5)
+
+    def testBatchTimeInRun(self):
+        log = []
+        v = trellis.Value(0)
+        d(trellis.Performer)
+        def watch():
+            log.append(v.value)
+        def inc():
+            v.value += 1
+        self.loop.batch_time = 60
+        for i in range(100):
+            self.loop.call(inc)
+        self.loop.call(self.loop.stop)
+        self.loop.run()
+        self.assertEqual(log[-1], 100)
+        self.failUnless(len(log) < 5, log)  # not one recalculation per call
+
+    def testBatchedFlushError(self):
+        log = []
+        v = trellis.Value(0)
+        def inc():
+            v.value += 1
+            log.append(v.value)
+        def fail():
+            raise DummyError
+        self.loop.batch_size = 3
+        for f in inc, inc, fail, inc:
+            self.loop.call(f)
+        self.assertRaises(DummyError, self.loop.flush)
+        # the failed call is dropped, and the rest of its batch is kept
+        self.assertEqual(v.value, 0)
+        self.assertEqual(self.loop.queue_depth, 3)
+        self.loop.flush()
+        self.assertEqual(v.value, 3)
+        self.assertEqual(log, [1, 2, 1, 2, 3])
+
     def testUndoOfCall(self):
         log = []
         def do():
@@ -1325,6 +1636,66 @@ class TestDefaultEventLoop(unittest.TestCase):
         self.assertEqual(t._schedule, [t20._when, Max])
         self.assertEqual(list(t._events), [t20._when])
 
+    def testQuantizedClock(self):
+        now = [7200.5]
+        real_monotonic = activity._monotonic
+        activity._monotonic = lambda: now[0]
+        try:
+            t = Time(monotonic=True, quantum=3600)
+            self.assertEqual(t.time(), 7200)
+            log = []
+            d(trellis.Performer)
+            def watch():
+                log.append(t._tick)
+            v = trellis.Value(0)
+            for i in range(5):
+                now[0] += 60
+                v.value = i     # the clock is polled, but didn't visibly change
+            self.assertEqual(log, [7200])
+            now[0] = 10800.25
+            v.value = 5
+            self.assertEqual(log, [7200, 10800])
+        finally:
+            activity._monotonic = real_monotonic
+
+    def testMonotonicClock(self):
+        if activity._monotonic is activity._clamped_time:
+            return  # no elapsed-time source on this platform
+        import time
+        t = Time(monotonic=True)
+        real_time = time.time
+        before = t.time()
+        time.time = lambda: real_time() + 3600    # set the clock ahead an hour
+        try:
+            after = t.time()
+        finally:
+            time.time = real_time
+        self.failUnless(0 <= after - before < 60)
+
+    def testTimingWheel(self):
+        t = Time(resolution=.25, auto_update=False)
+        t10, t20 = t[10], t[20.1]
+        watch10 = trellis.Value(True)
+        d(trellis.Cell)
+        def at10():
+            return watch10.value and t.reached(t10)
+        d(trellis.Cell)
+        def at20():
+            return t.reached(t20)
+        self.failIf(at10.value or at20.value)
+        self.assertEqual(len(t._schedule), 2)
+        self.assertEqual(t.next_event_time(), 10)
+        watch10.value = False   # stop watching t10, so it'll disconnect
+        self.failIf(at10.value)
+        self.assertEqual(len(t._schedule), 1)
+        self.assertEqual(t.next_event_time(), 20.25)
+        t.advance(20.1)
+        self.failIf(at20.value)
+        t.advance(.15)
+        self.failUnless(at20.value)
+        self.assertEqual(len(t._schedule), 0)
+        self.assertEqual(t.next_event_time(), None)
+
 
 
 
@@ -1370,6 +1741,194 @@ class TestTasks(unittest.TestCase):
         t._loop.flush()
         self.assertEqual(log, [1, 2])
 
+    def testReadyTasksShareOneCall(self):
+        log = []
+        def f(name):
+            log.append(name)
+            yield activity.Pause
+        t1 = activity.TaskCell(lambda: f(1))
+        t2 = activity.TaskCell(lambda: f(2))
+        self.assertEqual(EventLoop.queue_depth, 1)  # one call runs them all
+        EventLoop.flush()
+        self.assertEqual(log, [1, 2])
+
+    def testTasksWriteSameCell(self):
+        out = trellis.Value(None)
+        trigger = trellis.Value(0)
+        log = []
+        def f(name):
+            while True:
+                if trigger.value:
+                    out.value = name, trigger.value    # conflicts if shared
+                    log.append((name, trigger.value))
+                yield activity.Pause
+        t1 = activity.TaskCell(lambda: f(1))
+        t2 = activity.TaskCell(lambda: f(2))
+        EventLoop.flush()
+        trigger.value = 1
+        EventLoop.flush()
+        self.assertEqual(sorted(log), [(1, 1), (2, 1)])
+        EventLoop.batch_size = 10   # batched calls still run tasks separately
+        try:
+            trigger.value = 2
+            EventLoop.flush()
+        finally:
+            EventLoop.batch_size = None
+        self.assertEqual(sorted(log), [(1, 1), (1, 2), (2, 1), (2, 2)])
+        self.assertEqual(EventLoop.queue_depth, 0)
+
+    def testTaskPriorities(self):
+        # use a fresh EventLoop, so its task_stats don't leak into other tests
+        state = context.new()
+        state.__enter__()
+        try:
+            log = []
+            def f(name):
+                log.append(name)
+                yield activity.Pause
+            class App(trellis.Component):
+                trellis.attrs(x=0)
+                activity.task(priority=2)
+                def urgent(self):
+                    self.x
+                    log.append('urgent')
+                    yield activity.Pause
+            t1 = activity.TaskCell(lambda: f('low'), priority=-1)
+            t2 = activity.TaskCell(lambda: f('normal'))
+            app = App()
+            EventLoop.flush()
+            self.assertEqual(log, ['urgent', 'normal', 'low'])
+            self.assertEqual(sorted(EventLoop.task_stats), [-1, 0, 2])
+        finally:
+            state.__exit__(None, None, None)
+
+    def testPostFromThread(self):
+        import threading
+        v = trellis.Value(0)
+        log = []
+        d(trellis.Performer)
+        def watch():
+            log.append(v.value)
+        def worker():
+            for i in range(1, 6):
+                EventLoop.post(v, i)
+        t = threading.Thread(target=worker)
+        t.start(); t.join()
+        self.assertEqual(log, [0])
+        EventLoop.conflate = True
+        try:
+            EventLoop.flush()
+        finally:
+            EventLoop.conflate = False
+        self.assertEqual(log, [0, 5])
+
+    def testPostedValueError(self):
+        v = trellis.Value(0)
+        w = trellis.Value(0)
+        def checked():
+            if v.value == 13:
+                raise DummyError
+            return v.value
+        c = trellis.Cell(checked)
+        log = []
+        d(trellis.Performer)
+        def watch():
+            log.append((c.value, w.value))
+        EventLoop.post(w, 1)
+        EventLoop.post(v, 13)
+        self.assertRaises(DummyError, EventLoop.flush)
+        self.assertEqual(log, [(0, 0), (0, 1)])     # only the bad value is lost
+        EventLoop.flush()
+        self.assertEqual(log, [(0, 0), (0, 1)])     # ...and it isn't retried
+        EventLoop.post(v, 2)
+        EventLoop.flush()
+        self.assertEqual(log, [(0, 0), (0, 1), (2, 1)])
+
+    def testYieldFuture(self):
+        log = []
+        class Done(object):
+            def __init__(self, value):
+                self.value = value
+            def add_done_callback(self, cb):
+                cb(self)
+            def result(self):
+                if isinstance(self.value, Exception):
+                    raise self.value
+                return self.value
+        v = trellis.Value(0)
+        def f():
+            v.value
+            yield Done(42); log.append(activity.resume())
+            try:
+                yield Done(DummyError()); activity.resume()
+            except DummyError:
+                log.append('error')
+        t = activity.TaskCell(f)
+        EventLoop.flush()
+        self.assertEqual(EventLoop._jobs, 1)
+        v.value = 1     # doesn't wake the waiting task
+        self.assertEqual(log, [])
+        EventLoop.flush()
+        EventLoop.flush()
+        self.assertEqual(log, [42, 'error'])
+        self.assertEqual(EventLoop._jobs, 0)
+
+    def testRolledBackWait(self):
+        class Done(object):
+            def add_done_callback(self, cb):
+                cb(self)
+            def result(self):
+                return 42
+        log = []
+        class Task(object):
+            def _receive(self, future):
+                log.append(future.result())
+        future = Done()
+        def wait_and_fail():
+            EventLoop._wait_for(Task(), future)
+            raise DummyError
+        self.assertRaises(DummyError, trellis.atomically, wait_and_fail)
+        self.assertEqual(EventLoop._jobs, 0)
+        EventLoop.flush()
+        self.assertEqual(log, [])
+        # a future nobody is waiting for (any more) is ignored
+        EventLoop._post(None, EventLoop._job_done, future)
+        EventLoop.flush()
+        self.assertEqual(log, [])
+        self.assertEqual(EventLoop._jobs, 0)
+        trellis.atomically(EventLoop._wait_for, Task(), future)
+        EventLoop.flush()
+        self.assertEqual(log, [42])
+        self.assertEqual(EventLoop._jobs, 0)
+
+    def testWaitForFutureWithoutPolling(self):
+        # use a fresh EventLoop, so other tests' calls don't keep it busy
+        state = context.new()
+        state.__enter__()
+        try:
+            import threading
+            class Later(object):
+                def add_done_callback(self, cb):
+                    threading.Timer(.1, cb, (self,)).start()
+                def result(self):
+                    return 42
+            log = []
+            def f():
+                yield Later(); log.append(activity.resume())
+                EventLoop.stop()
+            loop = EventLoop.get()
+            real_flush, flushes = loop.flush, []
+            def flush(count=0):
+                flushes.append(count)
+                real_flush(count)
+            loop.flush = flush
+            t = activity.TaskCell(f)
+            EventLoop.run()
+            self.assertEqual(log, [42])
+            self.failUnless(len(flushes) < 10, len(flushes))
+        finally:
+            state.__exit__(None, None, None)
+
     def testDependencyAndCallback(self):
         log = []
         v = trellis.Value(42)
@@ -1597,6 +2156,80 @@ class TestTasks(unittest.TestCase):
 
 
 
+class Snapshotted(trellis.Component):
+    trellis.attrs(x = 1, y = 2)
+    log = []
+    items = trellis.make(trellis.Set)
+
+    trellis.maintain()
+    def total(self):
+        self.log.append(self.x)
+        return self.x + self.y + len(self.items)
+
+    trellis.maintain()
+    def doubled(self):
+        return self.total * 2
+
+    trellis.compute()
+    def lazy(self):
+        return self.x
+
+    trellis.maintain()
+    def uses_lazy(self):
+        self.log.append('lazy')
+        return self.lazy
+
+class TestSnapshot(unittest.TestCase):
+
+    def roundtrip(self, *obs):
+        from cStringIO import StringIO
+        f = StringIO()
+        trellis.snapshot(obs, f)
+        f.seek(0)
+        del Snapshotted.log[:]
+        return trellis.restore(f)
+
+    def testRulesAreNotRerun(self):
+        s = Snapshotted(x=5)
+        s.items.add(99)
+        s2, = self.roundtrip(s)
+        self.assertEqual(s2.total, 8)
+        self.assertEqual(s2.doubled, 16)
+        self.assertEqual(list(s2.items), [99])
+        self.failIf(5 in Snapshotted.log)
+
+    def testDependenciesAreRestored(self):
+        s2, = self.roundtrip(Snapshotted())
+        s2.x = 10
+        self.assertEqual(s2.total, 12)
+        self.assertEqual(s2.doubled, 24)
+        s2.items.add(1)
+        self.assertEqual(s2.doubled, 26)
+
+    def testUnsavedDependenciesAreRecalculated(self):
+        s2, = self.roundtrip(Snapshotted(x=3))
+        # uses_lazy depended on a @compute, which can't be saved
+        self.assertEqual(Snapshotted.log, ['lazy'])
+        self.assertEqual(s2.uses_lazy, 3)
+        s2.x = 4
+        self.assertEqual(s2.uses_lazy, 4)
+
+    def testSharedComponentsAndCells(self):
+        s1 = Snapshotted()
+        s2 = Snapshotted(items=s1.items)
+        trellis.Cells(s2)['x'] = trellis.Cells(s1)['x']
+        r1, r2 = self.roundtrip(s1, s2)
+        self.failUnless(r1.items is r2.items)
+        self.failUnless(trellis.Cells(r1)['x'] is trellis.Cells(r2)['x'])
+        r1.x = 7
+        self.assertEqual(r2.total, 9)
+
+    def testBareCellsCantBeSaved(self):
+        s = Snapshotted()
+        s.extra = trellis.Cell(value=1)
+        self.assertRaises(TypeError, self.roundtrip, s)
+
+
 class SortedSetTestCase(unittest.TestCase):
 
     def testUnicodeSort(self):
@@ -1629,6 +2262,159 @@ class SortedSetTestCase(unittest.TestCase):
         data.add(2)
         self.failUnlessEqual(list(sorted_set), [1, 2])
 
+    def testManyBlocks(self):
+        old_load = collections._SortedBlocks.load
+        collections._SortedBlocks.load = 4
+        try:
+            self.checkManyUpdates(False)
+            self.checkManyUpdates(True)
+        finally:
+            collections._SortedBlocks.load = old_load
+
+    def testWindow(self):
+        data = trellis.Set(range(0, 100, 2))
+        sorted_set = collections.SortedSet(data=data)
+        window = collections.SortedWindow(source=sorted_set, offset=10, limit=5)
+        log = []
+        d(trellis.Performer)
+        def watch():
+            log.append(window.changes)
+        self.assertEqual(list(window), [20, 22, 24, 26, 28])
+        data.add(51)        # below the window: nothing happens
+        data.add(99)
+        self.assertEqual(log, [[]])
+        data.add(23)        # inside the window
+        self.assertEqual(list(window), [20, 22, 23, 24, 26])
+        self.assertEqual(log[-2], [(2, 5, 3)])
+        def replace():
+            data.remove(0)
+            data.add(1)     # net shift of zero above the window
+        trellis.atomically(replace)
+        self.assertEqual(list(window), [20, 22, 23, 24, 26])
+        data.remove(2)      # shifts the window's contents
+        self.assertEqual(list(window), [22, 23, 24, 26, 28])
+        self.assertEqual(log[-2], [(0, 5, 5)])
+        window.offset = 0
+        self.assertEqual(list(window), [1, 4, 6, 8, 10])
+        self.assertEqual(log[-2], [(0, 5, 5)])
+        sorted_set.reverse = True
+        self.assertEqual(list(window), [99, 98, 96, 94, 92])
+
+    def checkManyUpdates(self, reverse):
+        import random
+        r = random.Random(42)
+        data = trellis.Set(range(0, 200, 2))
+        sorted_set = collections.SortedSet(data=data, reverse=reverse)
+        mirror = list(sorted_set)
+        d(trellis.Performer)
+        def track():
+            # apply the changes in order, as slices of the old list
+            changes, new = sorted_set.changes, list(sorted_set)
+            for n, (start, end, size) in enumerate(changes):
+                offset = sum([sz-(e-s) for s,e,sz in changes[n+1:]])
+                pos = start + offset
+                mirror[start:end] = new[pos:pos+size]
+        def update():
+            for i in range(20):
+                data.add(r.randrange(400))
+                data.discard(r.randrange(400))
+        for i in range(20):
+            trellis.atomically(update)
+            expected = sorted(data, reverse=reverse)
+            self.failUnlessEqual(list(sorted_set), expected)
+            self.failUnlessEqual(mirror, expected)
+            middle = len(data) // 2
+            self.failUnlessEqual(sorted_set[middle], expected[middle])
+
+
+class HubTestCase(unittest.TestCase):
+
+    def testMixedShapes(self):
+        import random
+        r = random.Random(42)
+        hub = collections.Hub()
+        def choice():
+            return r.choice([None, None, 1, 2, 3])
+        rules = set([(choice(), choice(), choice()) for i in range(40)])
+        rules.add((None, None))
+        seen = {}
+        def watcher(rule):
+            seen[rule] = []
+            def watch():
+                seen[rule].extend(hub.get(*rule))
+            return trellis.Performer(watch)
+        watchers = [watcher(rule) for rule in rules]
+        rows = [(choice(), choice(), choice()) for i in range(100)] + [(1, 2)]
+        def send():
+            for row in rows:
+                hub.put(*row)
+        trellis.atomically(send)
+        for rule in rules:
+            self.failUnlessEqual(seen[rule], [
+                row for row in rows if len(row)==len(rule) and
+                    [v for v, p in zip(row, rule) if p is not None]
+                    == [p for p in rule if p is not None]
+            ])
+        self.failUnless(hub._index)
+        del watchers
+        self.failUnlessEqual(hub._index, {})
+        self.assertRaises(TypeError, hub.put, [])
+
+
+class FilteredSetTestCase(unittest.TestCase):
+
+    def checkChanges(self, subset, update):
+        import random
+        r = random.Random(42)
+        log = []
+        def record():
+            if subset.added or subset.removed:
+                log.append((set(subset.added), set(subset.removed)))
+        record = trellis.Performer(record)
+        for i in range(50):
+            before = set(subset)
+            del log[:]
+            trellis.atomically(update, r)
+            after = set(subset)
+            changes = after-before, before-after
+            self.failUnlessEqual(log, filter(any, [changes]))
+            self.failUnless(after <= set(subset.base))
+
+    def testSubSet(self):
+        base = trellis.Set(range(20))
+        subset = collections.SubSet(range(0, 20, 3), base=base)
+        def update(r):
+            for i in range(5):
+                base.add(r.randrange(40))
+                base.discard(r.randrange(40))
+                subset.add(r.randrange(40))
+                subset.discard(r.randrange(40))
+        self.checkChanges(subset, update)
+
+    def testFilteredSet(self):
+        base = trellis.Set(range(20))
+        subset = collections.FilteredSet(base=base, predicate=lambda n: n%3)
+        def update(r):
+            for i in range(5):
+                base.add(r.randrange(40))
+                base.discard(r.randrange(40))
+        self.checkChanges(subset, update)
+        self.failUnlessEqual(set(subset), set([n for n in base if n%3]))
+
+    def testFilteredSetIsReadOnly(self):
+        base = trellis.Set(range(5))
+        subset = collections.FilteredSet(base=base, predicate=lambda n: n%2)
+        for op, arg in [
+            (subset.add, 7), (subset.discard, 1), (subset.remove, 1),
+            (subset.update, [7]), (subset.difference_update, [1]),
+            (subset.intersection_update, [1]),
+            (subset.symmetric_difference_update, [1]),
+        ]:
+            self.assertRaises(TypeError, op, arg)
+        self.assertRaises(TypeError, subset.clear)
+        self.assertRaises(AttributeError, setattr, subset, 'base', base)
+        self.failUnlessEqual(set(subset), set([1, 3]))
+
 
 
 